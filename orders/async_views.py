@@ -0,0 +1,105 @@
+"""Async views for orders.
+
+These views await the provider call instead of blocking a worker for the full
+upstream round trip, so a single ASGI process can keep many orders in flight.
+ORM work still runs synchronously and is moved off the event loop with
+`sync_to_async`.
+"""
+
+import json
+import math
+from abc import ABC, abstractmethod
+
+from asgiref.sync import sync_to_async
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.status import HTTP_400_BAD_REQUEST, HTTP_401_UNAUTHORIZED, HTTP_429_TOO_MANY_REQUESTS
+
+from orders.provider import provider, ProviderError
+from orders.views import OrderPlacement
+from users.models import User
+from users.permissions import CachedTokenAuthentication, UserHasAPIKey
+from users.throttling import AppOrderThrottle, UserOrderThrottle, throttle_wait
+
+
+class AsyncCreateOrderView(OrderPlacement, View, ABC):
+    """Create order for user without blocking on the provider."""
+
+    http_method_names = ['post', 'options']
+    throttle_classes = []
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        """Exempt from CSRF like DRF views, authentication is done with headers."""
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    @abstractmethod
+    def get_user(self, request):
+        """Return authenticated user or None, runs in a worker thread."""
+        pass
+
+    async def post(self, request):
+        """Order a number for user."""
+        wait = throttle_wait(self.throttle_classes, request, self)
+        if wait is not None:
+            response = JsonResponse(status=HTTP_429_TOO_MANY_REQUESTS,
+                                    data={'detail': exceptions.Throttled(wait).detail})
+            response['Retry-After'] = str(math.ceil(wait))
+            return response
+
+        self.user = await sync_to_async(self.get_user)(request)
+        if self.user is None:
+            return JsonResponse(status=HTTP_401_UNAUTHORIZED,
+                                data={'detail': 'Authentication credentials were not provided.'})
+
+        try:
+            request_data = json.loads(request.body or b'{}')
+        except ValueError:
+            return JsonResponse(status=HTTP_400_BAD_REQUEST, data={'message': 'Invalid JSON body'})
+
+        order_serializer, error = await sync_to_async(self.prepare_order)(request_data)
+        if error:
+            status, data = error
+            return JsonResponse(status=status, data=data)
+
+        try:
+            response = await provider.aorder_number(
+                order_serializer.validated_data['service'],
+                order_serializer.validated_data['country']
+            )
+        except ProviderError as e:
+            status, data = await sync_to_async(self.provider_error)(e, order_serializer)
+        except Exception:
+            await sync_to_async(self.release_order)(order_serializer)
+            raise
+        else:
+            status, data = await sync_to_async(self.create_order)(response, order_serializer)
+        return JsonResponse(status=status, data=data)
+
+
+class AsyncCreateAppOrderView(AsyncCreateOrderView):
+    """Handle order creation requests from frontend app."""
+
+    throttle_classes = [AppOrderThrottle, ]
+
+    def get_user(self, request):
+        """Authenticate user from token."""
+        try:
+            user_auth = CachedTokenAuthentication().authenticate(request)
+        except exceptions.AuthenticationFailed:
+            return None
+        return user_auth[0] if user_auth else None
+
+
+class AsyncCreateUserOrderView(AsyncCreateOrderView):
+    """Handle order creation requests from API key."""
+
+    throttle_classes = [UserOrderThrottle, ]
+
+    def get_user(self, request):
+        """Authenticate user from API key."""
+        if not UserHasAPIKey().has_permission(request, self):
+            return None
+        return User.objects.get(pk=request.api_key_user_id)
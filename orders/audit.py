@@ -0,0 +1,152 @@
+"""Write-behind buffer for SMS history records."""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+import environ
+from django.db import close_old_connections
+
+from orders.models import SMSHistory
+
+env = environ.Env()
+environ.Env.read_env()
+
+logger = logging.getLogger(__name__)
+
+# Seconds the flush thread waits for records before checking whether it was stopped.
+STOP_CHECK_INTERVAL = 0.1
+
+
+class SMSHistoryBuffer:
+    """Collect SMSHistory rows in memory and write them with bulk_create.
+
+    A background thread per worker process flushes the buffer when `flush_size`
+    records are waiting or `flush_interval` seconds have passed, and whatever is
+    left is written on process exit. The buffer is bounded: when it is full
+    because the database is slow, the caller writes its record directly, so
+    history is not allowed to grow memory without limit. A batch the database
+    keeps refusing is retried `max_retries` times with a doubling delay, then
+    written record by record, dropping and logging the records that fail.
+    """
+
+    def __init__(self, enabled=True, max_size=10000, flush_size=200, flush_interval=1.0, retry_delay=1.0,
+                 max_retries=5):
+        self.enabled = enabled
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retry_delay = retry_delay
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def add(self, request_data):
+        """Record request params of a webhook call."""
+        record = SMSHistory(request_data=request_data)
+        if not self.enabled:
+            record.save()
+            return
+
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            record.save()
+
+    def _ensure_started(self):
+        """Start flush thread for this process, again after a fork."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # Records copied from the parent process are flushed by the parent.
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sms-history-buffer', daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def _take(self):
+        """Wait for up to flush_size records or flush_interval seconds, less once stopped."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.flush_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=min(remaining, STOP_CHECK_INTERVAL)))
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+        return batch
+
+    def _write(self, batch):
+        """Write batch, retrying with backoff, then record by record dropping the ones that fail."""
+        for attempt in range(self.max_retries + 1):
+            close_old_connections()
+            try:
+                SMSHistory.objects.bulk_create(batch)
+                return
+            except Exception:
+                logger.exception('Could not write %s SMS history records', len(batch))
+            if attempt == self.max_retries or self._stop.is_set():
+                break
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+        dropped = []
+        for record in batch:
+            try:
+                record.save()
+            except Exception:
+                dropped.append(record)
+        if dropped:
+            logger.error('Dropped %s SMS history records: %r', len(dropped),
+                         [record.request_data for record in dropped])
+
+    def _run(self):
+        """Flush batches until stopped and the buffer is empty."""
+        while not self._stop.is_set() or not self.queue.empty():
+            batch = self._take()
+            if batch:
+                self._write(batch)
+        close_old_connections()
+
+    def flush(self):
+        """Write all buffered records from the calling thread."""
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def close(self):
+        """Stop flush thread and write what is left."""
+        if self._pid != os.getpid():
+            # Nothing was buffered by this process, a copy inherited on fork belongs to the parent.
+            return
+        self._stop.set()
+        self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+sms_history = SMSHistoryBuffer(
+    enabled=env.bool('SMS_HISTORY_BUFFERED', default=True),
+    max_size=env.int('SMS_HISTORY_BUFFER_SIZE', default=10000),
+    flush_size=env.int('SMS_HISTORY_FLUSH_SIZE', default=200),
+    flush_interval=env.float('SMS_HISTORY_FLUSH_INTERVAL', default=1.0),
+    max_retries=env.int('SMS_HISTORY_MAX_RETRIES', default=5),
+)
@@ -0,0 +1,69 @@
+"""Replies of order placements retried with the same Idempotency-Key header.
+
+The first request with a key claims it with `cache.add` and stores its status
+and response data under the key once the provider was called; requests
+refused before any debit, such as invalid data or insufficient funds, drop the
+claim so they can be corrected and sent again. Requests repeating the key get
+the stored reply, waiting for it while the first one is still in flight, so a
+retry never orders a second number or debits twice. Keys live in the cache
+named by IDEMPOTENCY_CACHE, which must be shared by all processes for retries
+landing on another worker to be recognised.
+"""
+
+import json
+import time
+from hashlib import sha256
+
+import environ
+from django.core.cache import caches
+
+env = environ.Env()
+environ.Env.read_env()
+
+replies = caches[env('IDEMPOTENCY_CACHE', default='default')]
+REPLY_TIMEOUT = env.int('IDEMPOTENCY_TTL', default=24 * 60 * 60)
+# Longer than a provider call with its retries, after which a crashed request's claim is dropped.
+CLAIM_TIMEOUT = env.int('IDEMPOTENCY_CLAIM_TIMEOUT', default=60)
+# Well below the worker timeout, so a waiting retry answers 409 instead of being killed.
+WAIT_TIMEOUT = env.float('IDEMPOTENCY_WAIT', default=10)
+POLL_INTERVAL = 0.1
+MAX_KEY_LENGTH = 255
+
+
+def reply_key(user_id, idempotency_key):
+    """Cache key of the reply to user's requests with idempotency_key."""
+    return f'idempotency:{user_id}:{sha256(idempotency_key.encode()).hexdigest()}'
+
+
+def fingerprint(data):
+    """Digest of request data, to tell a retry from a different request reusing the key."""
+    return sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def claim(key, digest):
+    """Claim key for a request with data digest, or wait for the reply of the request holding it.
+
+    Return (True, None) if claimed, (False, (digest, reply)) with what the
+    holder stored, or (False, None) if the holder did not reply in time. A
+    different request reusing the key is returned at once, without waiting.
+    """
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while True:
+        if replies.add(key, (digest, None), CLAIM_TIMEOUT):
+            return True, None
+        stored = replies.get(key)
+        if stored is not None and (stored[0] != digest or stored[1] is not None):
+            return False, stored
+        if time.monotonic() >= deadline:
+            return False, None
+        time.sleep(POLL_INTERVAL)
+
+
+def store(key, digest, status, data):
+    """Store reply of the request holding the claim."""
+    replies.set(key, (digest, (status, data)), REPLY_TIMEOUT)
+
+
+def release(key):
+    """Drop claim without a reply, so the request can be retried."""
+    replies.delete(key)
@@ -0,0 +1,132 @@
+"""Email outbox sent in batches by a worker instead of inside requests.
+
+Emails are stored in the EmailOutbox table and sent by the send_outbox command
+through the backend named by EMAIL_OUTBOX_BACKEND. Failed sends are retried
+with exponential backoff until max_attempts is reached.
+"""
+
+from datetime import timedelta
+
+import environ
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail
+
+from orders.models import EmailOutbox
+
+env = environ.Env()
+environ.Env.read_env()
+
+
+class SendGridBackend:
+    """Send with the SendGrid API, one client reused for all sends of the process."""
+
+    def __init__(self):
+        self.client = SendGridAPIClient(env('EMAIL_PASS', default=''))
+        # Without a timeout a hung request blocks the worker forever.
+        self.client.client.timeout = settings.EMAIL_TIMEOUT
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def send(self, email):
+        """Send email, raise on failure."""
+        response = self.client.send(Mail(
+            from_email=email.sender,
+            to_emails=email.receiver,
+            subject=email.subject,
+            html_content=email.html
+        ))
+        if response.status_code >= 300:
+            raise RuntimeError(f'SendGrid answered {response.status_code}: {response.body}')
+
+
+class DjangoMailBackend:
+    """Send with Django's EMAIL_BACKEND, e.g. the file or locmem backend to run offline."""
+
+    def __init__(self):
+        self.connection = get_connection(fail_silently=False)
+
+    def open(self):
+        self.connection.open()
+
+    def close(self):
+        self.connection.close()
+
+    def send(self, email):
+        """Send email, raise on failure."""
+        message = EmailMultiAlternatives(email.subject, email.html, email.sender, [email.receiver],
+                                         connection=self.connection)
+        message.attach_alternative(email.html, 'text/html')
+        message.send()
+
+
+def get_backend():
+    """Create backend named by EMAIL_OUTBOX_BACKEND."""
+    return import_string(env('EMAIL_OUTBOX_BACKEND', default='orders.mail.SendGridBackend'))()
+
+
+def enqueue(sender, receiver, subject, html):
+    """Store email for the outbox worker."""
+    return EmailOutbox.objects.create(sender=sender, receiver=receiver, subject=subject, html=html)
+
+
+def retry_delay(attempts, backoff, max_delay):
+    """Delay before the next attempt after the given number of failed ones."""
+    return timedelta(seconds=min(max_delay, backoff * 2 ** (attempts - 1)))
+
+
+def send_outbox(backend, batch_size=100, max_attempts=8, backoff=30, max_delay=60 * 60, lease=30 * 60):
+    """Send a batch of due emails, return (sent, failed).
+
+    Rows are claimed in a short transaction with SKIP LOCKED, so several
+    workers can send side by side, by counting the attempt and moving the next
+    attempt lease seconds ahead. They are sent outside the transaction and
+    each is marked right after its send, so a worker dying midway leaves the
+    emails it had not sent to be retried once the lease ends, resending at most
+    the one it was sending. The lease has to outlast a batch of sends, each
+    bounded by EMAIL_TIMEOUT. An email failing max_attempts times is left
+    unsent without a next attempt.
+    """
+    with transaction.atomic():
+        now = timezone.now()
+        emails = list(
+            EmailOutbox.objects
+            .select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'id')[:batch_size]
+        )
+        if not emails:
+            return 0, 0
+        for email in emails:
+            email.attempts += 1
+            email.next_attempt_at = now + timedelta(seconds=lease)
+        EmailOutbox.objects.bulk_update(emails, ['attempts', 'next_attempt_at'])
+
+    failed = 0
+    backend.open()
+    try:
+        for email in emails:
+            try:
+                backend.send(email)
+            except Exception as e:
+                failed += 1
+                email.last_error = f'{type(e).__name__}: {e}'
+                email.next_attempt_at = (
+                    timezone.now() + retry_delay(email.attempts, backoff, max_delay)
+                    if email.attempts < max_attempts else None
+                )
+            else:
+                email.sent_at = timezone.now()
+                email.last_error = ''
+            email.save(update_fields=['next_attempt_at', 'sent_at', 'last_error'])
+    finally:
+        backend.close()
+    return len(emails) - failed, failed
@@ -0,0 +1,29 @@
+"""Base of the worker commands."""
+
+import time
+from abc import ABC, abstractmethod
+
+from django.core.management.base import BaseCommand
+
+
+class IntervalCommand(BaseCommand, ABC):
+    """Command doing one round of work, or with --interval a round every given number of seconds."""
+
+    interval_help = 'Keep running and repeat every given number of seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help=self.interval_help)
+
+    @abstractmethod
+    def handle_once(self, **options):
+        """Do one round of work, return a line to report or None to stay quiet."""
+        pass
+
+    def handle(self, *args, **options):
+        while True:
+            report = self.handle_once(**options)
+            if report:
+                self.stdout.write(report)
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
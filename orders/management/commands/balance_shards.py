@@ -0,0 +1,36 @@
+"""Manage sharded balances."""
+
+from django.core.management.base import CommandError
+
+from orders.management.base import IntervalCommand
+from orders.models import UserBalance
+from users.models import User
+
+
+class Command(IntervalCommand):
+    """Split balances of users with many concurrent orders into shards and rebalance the shards."""
+
+    help = 'Set the number of balance shards of a user, or rebalance the shards of sharded users.'
+    interval_help = 'Keep running and rebalance every given number of seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help='Email of the user to set the number of shards for.')
+        parser.add_argument('--shards', type=int,
+                            help='Number of shards for the user, 0 to stop sharding the balance.')
+        super().add_arguments(parser)
+
+    def handle(self, *args, **options):
+        if options['user'] is not None:
+            if options['shards'] is None or options['shards'] < 0:
+                raise CommandError('--shards must be given as a number of shards or 0 with --user.')
+            try:
+                user_id = User.objects.values_list('pk', flat=True).get(email=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f'User {options["user"]} does not exist.')
+            UserBalance.set_shards(user_id, options['shards'])
+            self.stdout.write(f'Balance of {options["user"]} split into {options["shards"]} shards')
+            return
+        super().handle(*args, **options)
+
+    def handle_once(self, **options):
+        return f'Rebalanced {UserBalance.rebalance()} balances'
@@ -0,0 +1,24 @@
+"""Fold balance ledger entries into balance snapshots."""
+
+from datetime import timedelta
+
+from orders.management.base import IntervalCommand
+from orders.models import UserBalance
+
+
+class Command(IntervalCommand):
+    """Keep the ledger entries read on top of balance snapshots few."""
+
+    help = 'Fold ledger entries older than the lag into the balance snapshots.'
+    interval_help = 'Keep running and compact every given number of seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lag', type=float, default=60,
+                            help='Seconds an entry is left in the ledger tail before it is folded into its snapshot.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of entries folded per transaction.')
+        super().add_arguments(parser)
+
+    def handle_once(self, **options):
+        compacted = UserBalance.compact(lag=timedelta(seconds=options['lag']), batch_size=options['batch_size'])
+        return f'Compacted {compacted} balances'
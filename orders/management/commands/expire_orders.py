@@ -0,0 +1,28 @@
+"""Expire overdue orders in bulk."""
+
+from orders.management.base import IntervalCommand
+from orders.models import Order
+
+
+class Command(IntervalCommand):
+    """Mark pending orders older than the expiry time as expired and refund them."""
+
+    help = 'Expire overdue pending orders and refund their amounts.'
+    interval_help = 'Keep running and sweep every given number of seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of orders expired per transaction.')
+        super().add_arguments(parser)
+
+    def sweep(self, batch_size):
+        """Expire all overdue orders in batches, return number expired."""
+        total = 0
+        while True:
+            expired = Order.expire_overdue(batch_size=batch_size)
+            total += expired
+            if expired < batch_size:
+                return total
+
+    def handle_once(self, **options):
+        return f'Expired {self.sweep(options["batch_size"])} orders'
@@ -0,0 +1,31 @@
+"""Apply queued SMS to orders."""
+
+from orders.management.base import IntervalCommand
+from orders.sms import drain_inbox
+
+
+class Command(IntervalCommand):
+    """Drain the SMS inbox filled by push_sms in queue ingest mode."""
+
+    help = 'Apply SMS queued in the inbox to their orders.'
+    interval_help = 'Keep running and poll the inbox every given number of seconds when it is empty.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of SMS applied per transaction.')
+        super().add_arguments(parser)
+
+    def drain(self, batch_size):
+        """Apply queued SMS in batches until the inbox is empty, return number applied."""
+        total = 0
+        while True:
+            applied = drain_inbox(batch_size=batch_size)
+            total += applied
+            if applied < batch_size:
+                return total
+
+    def handle_once(self, **options):
+        applied = self.drain(options['batch_size'])
+        if applied or not options['interval']:
+            return f'Applied {applied} SMS'
+        return None
@@ -0,0 +1,30 @@
+"""Verify balance snapshots against the ledger."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+
+from orders.models import UserBalance, to_major
+
+
+class Command(BaseCommand):
+    """Report balance snapshots that differ from the sum of the ledger entries they cover."""
+
+    help = 'Check that every balance snapshot matches the ledger entries folded into it.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Reset mismatching snapshots to the sum of their ledger entries.')
+
+    def handle(self, *args, **options):
+        mismatches = UserBalance.reconcile()
+        for user_id, snapshot, ledger in mismatches:
+            self.stdout.write(f'User {user_id}: snapshot {to_major(snapshot)}, ledger {to_major(ledger)}')
+            if options['fix']:
+                UserBalance.objects.filter(pk=user_id).update(amount=F('amount') + ledger - snapshot)
+
+        if not mismatches:
+            self.stdout.write('All balances match the ledger')
+        elif options['fix']:
+            self.stdout.write(f'Fixed {len(mismatches)} balances')
+        else:
+            raise CommandError(f'{len(mismatches)} balances do not match the ledger')
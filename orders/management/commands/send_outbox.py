@@ -0,0 +1,44 @@
+"""Send queued emails."""
+
+from orders.mail import get_backend, send_outbox
+from orders.management.base import IntervalCommand
+
+
+class Command(IntervalCommand):
+    """Send emails from the outbox in batches, retrying failed ones with backoff."""
+
+    help = 'Send emails queued in the outbox.'
+    interval_help = 'Keep running and poll the outbox every given number of seconds when it is empty.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of emails claimed at a time.')
+        parser.add_argument('--max-attempts', type=int, default=8,
+                            help='Number of attempts before an email is given up.')
+        parser.add_argument('--backoff', type=float, default=30,
+                            help='Seconds before the first retry, doubled on every further attempt.')
+        parser.add_argument('--lease', type=float, default=30 * 60,
+                            help='Seconds a claimed batch is kept from other workers, longer than its sends take.')
+        super().add_arguments(parser)
+
+    def drain(self, backend, options):
+        """Send due emails in batches until none are left, return numbers sent and failed."""
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = send_outbox(backend, batch_size=options['batch_size'],
+                                       max_attempts=options['max_attempts'], backoff=options['backoff'],
+                                       lease=options['lease'])
+            total_sent += sent
+            total_failed += failed
+            if sent + failed < options['batch_size']:
+                return total_sent, total_failed
+
+    def handle(self, *args, **options):
+        self.backend = get_backend()
+        super().handle(*args, **options)
+
+    def handle_once(self, **options):
+        sent, failed = self.drain(self.backend, options)
+        if sent or failed or not options['interval']:
+            return f'Sent {sent} emails, {failed} failed'
+        return None
@@ -0,0 +1,35 @@
+"""Maintain monthly partitions of SMS history."""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from orders.partitions import create_partitions, remove_partitions
+
+
+class Command(BaseCommand):
+    """Create upcoming SMS history partitions and remove old ones."""
+
+    help = 'Create SMS history partitions for upcoming months and drop or archive expired ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=2,
+                            help='Number of months after the current one to create partitions for.')
+        parser.add_argument('--retain', type=int, default=6,
+                            help='Number of months before the current one to keep.')
+        parser.add_argument('--archive', action='store_true',
+                            help='Detach expired partitions and keep them as standalone tables instead of dropping.')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('SMS history partitions are only supported on PostgreSQL.')
+
+        now = timezone.now()
+        with transaction.atomic(), connection.cursor() as cursor:
+            created = create_partitions(cursor, now, options['ahead'])
+            removed = remove_partitions(cursor, now, options['retain'], archive=options['archive'])
+
+        for name in created:
+            self.stdout.write(f'Created {name}')
+        for name in removed:
+            self.stdout.write(f'{"Archived" if options["archive"] else "Dropped"} {name}')
@@ -0,0 +1,50 @@
+# Indexes are built with CREATE INDEX CONCURRENTLY so they can be applied to a
+# live orders table without blocking writes. Concurrent index builds can not
+# run inside a transaction, hence atomic = False.
+#
+# The unique constraint on activation_id is added from an index built
+# concurrently beforehand, so the ALTER TABLE only needs a brief lock. It fails
+# if duplicate activation ids exist; those have to be cleaned up first.
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('orders', '0004_remove_order_sms_code_alter_order_status_ordersms'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['user', 'status', 'created_at'], name='order_user_status_created_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql='CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "order_activation_id_unique" '
+                        'ON "orders_order" ("activation_id");',
+                    reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "order_activation_id_unique";',
+                ),
+                migrations.RunSQL(
+                    sql='ALTER TABLE "orders_order" ADD CONSTRAINT "order_activation_id_unique" '
+                        'UNIQUE USING INDEX "order_activation_id_unique";',
+                    reverse_sql='ALTER TABLE "orders_order" DROP CONSTRAINT "order_activation_id_unique";',
+                ),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='order',
+                    constraint=models.UniqueConstraint(fields=['activation_id'], name='order_activation_id_unique'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,77 @@
+# SMS history is moved to a table partitioned by month of received_at. The old
+# table is renamed, a partitioned table is created in its place with a primary
+# key of (id, received_at) as PostgreSQL requires the partition key in it, and
+# existing rows are copied over with the migration time as received_at.
+
+from django.db import migrations, models
+from django.utils import timezone
+
+from orders.partitions import create_partitions
+
+
+def create_monthly_partitions(apps, schema_editor):
+    """Create partitions for this month and the next two."""
+    with schema_editor.connection.cursor() as cursor:
+        create_partitions(cursor, timezone.now(), ahead=2)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_order_indexes'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql=[
+                        'ALTER TABLE "orders_smshistory" RENAME TO "orders_smshistory_unpartitioned";',
+                        'ALTER TABLE "orders_smshistory_unpartitioned" '
+                        'RENAME CONSTRAINT "orders_smshistory_pkey" TO "orders_smshistory_unpartitioned_pkey";',
+                        'ALTER SEQUENCE "orders_smshistory_id_seq" RENAME TO "orders_smshistory_unpartitioned_id_seq";',
+                        'CREATE TABLE "orders_smshistory" ('
+                        '"id" bigserial NOT NULL, '
+                        '"request_data" jsonb NOT NULL, '
+                        '"received_at" timestamp with time zone NOT NULL, '
+                        'PRIMARY KEY ("id", "received_at")'
+                        ') PARTITION BY RANGE ("received_at");',
+                        'CREATE TABLE "orders_smshistory_default" PARTITION OF "orders_smshistory" DEFAULT;',
+                    ],
+                    reverse_sql=[
+                        'CREATE TABLE "orders_smshistory_unpartitioned" ('
+                        '"id" bigint NOT NULL PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY, '
+                        '"request_data" jsonb NOT NULL'
+                        ');',
+                        'INSERT INTO "orders_smshistory_unpartitioned" ("id", "request_data") '
+                        'SELECT "id", "request_data" FROM "orders_smshistory";',
+                        'SELECT setval(pg_get_serial_sequence(\'"orders_smshistory_unpartitioned"\', \'id\'), '
+                        'COALESCE(MAX("id"), 0) + 1, false) FROM "orders_smshistory_unpartitioned";',
+                        'DROP TABLE "orders_smshistory";',
+                        'ALTER TABLE "orders_smshistory_unpartitioned" RENAME TO "orders_smshistory";',
+                        'ALTER TABLE "orders_smshistory" '
+                        'RENAME CONSTRAINT "orders_smshistory_unpartitioned_pkey" TO "orders_smshistory_pkey";',
+                        'ALTER SEQUENCE "orders_smshistory_unpartitioned_id_seq" RENAME TO "orders_smshistory_id_seq";',
+                    ],
+                ),
+                migrations.RunPython(create_monthly_partitions, migrations.RunPython.noop),
+                migrations.RunSQL(
+                    sql=[
+                        'INSERT INTO "orders_smshistory" ("id", "request_data", "received_at") '
+                        'SELECT "id", "request_data", now() FROM "orders_smshistory_unpartitioned";',
+                        'SELECT setval(pg_get_serial_sequence(\'"orders_smshistory"\', \'id\'), '
+                        'COALESCE(MAX("id"), 0) + 1, false) FROM "orders_smshistory";',
+                        'DROP TABLE "orders_smshistory_unpartitioned";',
+                    ],
+                    reverse_sql=migrations.RunSQL.noop,
+                ),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='smshistory',
+                    name='received_at',
+                    field=models.DateTimeField(default=timezone.now),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# The digest column is added without a default so PostgreSQL does not rewrite
+# the table, and its unique constraint is attached to an index built
+# concurrently, as in 0005. Existing rows keep a NULL digest.
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('orders', '0006_smshistory_received_at_partitioned'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ordersms',
+            name='digest',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    sql='CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS "ordersms_digest_unique" '
+                        'ON "orders_ordersms" ("digest");',
+                    reverse_sql='DROP INDEX CONCURRENTLY IF EXISTS "ordersms_digest_unique";',
+                ),
+                migrations.RunSQL(
+                    sql='ALTER TABLE "orders_ordersms" ADD CONSTRAINT "ordersms_digest_unique" '
+                        'UNIQUE USING INDEX "ordersms_digest_unique";',
+                    reverse_sql='ALTER TABLE "orders_ordersms" DROP CONSTRAINT "ordersms_digest_unique";',
+                ),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name='ordersms',
+                    constraint=models.UniqueConstraint(fields=['digest'], name='ordersms_digest_unique'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,91 @@
+# Generated by Django 4.1.1 on 2026-10-18 13:11
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Coalesce, Round
+import django.db.models.deletion
+import django.utils.timezone
+
+MINOR_UNITS = 100
+
+
+def scale_to_minor_units(apps, schema_editor):
+    """Store balances in minor units before the column becomes an integer."""
+    UserBalance = apps.get_model('orders', 'UserBalance')
+    UserBalance.objects.update(amount=Round(models.F('amount') * MINOR_UNITS))
+
+
+def scale_to_major_units(apps, schema_editor):
+    UserBalance = apps.get_model('orders', 'UserBalance')
+    UserBalance.objects.update(amount=models.F('amount') / MINOR_UNITS)
+
+
+def open_ledger(apps, schema_editor):
+    """Record existing balances as opening ledger entries folded into the snapshots."""
+    UserBalance = apps.get_model('orders', 'UserBalance')
+    BalanceEntry = apps.get_model('orders', 'BalanceEntry')
+    balances = list(UserBalance.objects.exclude(amount=0))
+    entries = BalanceEntry.objects.bulk_create([
+        BalanceEntry(user_id=balance.pk, amount=balance.amount, kind='opening') for balance in balances
+    ])
+    for balance, entry in zip(balances, entries):
+        balance.last_entry_id = entry.pk
+    UserBalance.objects.bulk_update(balances, ['last_entry_id'], batch_size=1000)
+
+
+def close_ledger(apps, schema_editor):
+    """Fold all ledger entries into the balances before the ledger is dropped."""
+    UserBalance = apps.get_model('orders', 'UserBalance')
+    BalanceEntry = apps.get_model('orders', 'BalanceEntry')
+    delta = (
+        BalanceEntry.objects
+        .filter(user_id=models.OuterRef('pk'), id__gt=models.OuterRef('last_entry_id'))
+        .values('user_id')
+        .annotate(total=models.Sum('amount'))
+        .values('total')
+    )
+    UserBalance.objects.update(amount=models.F('amount') + Coalesce(models.Subquery(delta), 0))
+
+
+class Migration(migrations.Migration):
+    # Balances are changed in place and then altered, which PostgreSQL refuses in one transaction.
+    atomic = False
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orders', '0009_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userbalance',
+            name='compacted_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userbalance',
+            name='last_entry_id',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(scale_to_minor_units, scale_to_major_units, atomic=True),
+        migrations.AlterField(
+            model_name='userbalance',
+            name='amount',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='BalanceEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('opening', 'Opening'), ('deposit', 'Deposit'), ('order', 'Order'), ('refund', 'Refund')], max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='balance_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='balanceentry',
+            index=models.Index(fields=['user', 'id'], name='balanceentry_user_id_idx'),
+        ),
+        migrations.RunPython(open_ledger, close_ledger, atomic=True),
+    ]
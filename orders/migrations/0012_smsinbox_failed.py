@@ -0,0 +1,28 @@
+# Generated by Django 4.1.1 on 2026-10-18 13:27
+
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0011_balance_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smsinbox',
+            name='failed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='smsinbox',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddIndex(
+            model_name='smsinbox',
+            index=models.Index(django.db.models.fields.json.KeyTextTransform('activationId', 'payload'), condition=models.Q(('failed_at__isnull', True)), name='smsinbox_activation_id_idx'),
+        ),
+    ]
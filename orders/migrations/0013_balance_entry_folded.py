@@ -0,0 +1,51 @@
+# Generated by Django 4.1.1 on 2026-10-18 13:31
+
+from django.db import migrations, models
+
+
+def mark_folded(apps, schema_editor):
+    """Mark entries up to each snapshot's last entry as folded into it."""
+    UserBalance = apps.get_model('orders', 'UserBalance')
+    BalanceEntry = apps.get_model('orders', 'BalanceEntry')
+    last_entry_id = UserBalance.objects.filter(pk=models.OuterRef('user_id')).values('last_entry_id')
+    BalanceEntry.objects.filter(id__lte=models.Subquery(last_entry_id)).update(folded=True)
+
+
+def mark_last_entries(apps, schema_editor):
+    """Point each snapshot at its newest folded entry."""
+    UserBalance = apps.get_model('orders', 'UserBalance')
+    BalanceEntry = apps.get_model('orders', 'BalanceEntry')
+    last_folded = (
+        BalanceEntry.objects
+        .filter(user_id=models.OuterRef('pk'), folded=True)
+        .values('user_id')
+        .annotate(last=models.Max('id'))
+        .values('last')
+    )
+    UserBalance.objects.update(last_entry_id=models.functions.Coalesce(models.Subquery(last_folded), 0))
+
+
+class Migration(migrations.Migration):
+    # Entries are changed in place and then altered, which PostgreSQL refuses in one transaction.
+    atomic = False
+
+    dependencies = [
+        ('orders', '0012_smsinbox_failed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='balanceentry',
+            name='folded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_folded, mark_last_entries, atomic=True),
+        migrations.RemoveField(
+            model_name='userbalance',
+            name='last_entry_id',
+        ),
+        migrations.AddIndex(
+            model_name='balanceentry',
+            index=models.Index(condition=models.Q(('folded', False)), fields=['user'], name='balanceentry_unfolded_idx'),
+        ),
+    ]
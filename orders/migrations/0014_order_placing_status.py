@@ -0,0 +1,18 @@
+# Generated by Django 4.1.1 on 2026-10-18 13:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0013_balance_entry_folded'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='status',
+            field=models.CharField(choices=[('placing', 'Placing'), ('sms pending', 'Sms Pending'), ('success', 'Success'), ('finished', 'Finished'), ('expired', 'Expired'), ('cancelled', 'Cancelled')], default='sms pending', max_length=15),
+        ),
+    ]
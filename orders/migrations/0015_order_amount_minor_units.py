@@ -0,0 +1,43 @@
+# Generated by Django 4.1.1 on 2026-10-18 17:02
+
+from django.db import migrations, models
+from django.db.models.functions import Round
+import django.core.validators
+
+MINOR_UNITS = 100
+
+
+def scale_to_minor_units(apps, schema_editor):
+    """Store order and deposit amounts in minor units before the columns become integers."""
+    for model_name in ['Order', 'UserBalanceHistory']:
+        model = apps.get_model('orders', model_name)
+        model.objects.update(amount=Round(models.F('amount') * MINOR_UNITS))
+
+
+def scale_to_major_units(apps, schema_editor):
+    for model_name in ['Order', 'UserBalanceHistory']:
+        model = apps.get_model('orders', model_name)
+        model.objects.update(amount=models.F('amount') / MINOR_UNITS)
+
+
+class Migration(migrations.Migration):
+    # Amounts are changed in place and then altered, which PostgreSQL refuses in one transaction.
+    atomic = False
+
+    dependencies = [
+        ('orders', '0014_order_placing_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(scale_to_minor_units, scale_to_major_units, atomic=True),
+        migrations.AlterField(
+            model_name='order',
+            name='amount',
+            field=models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+        migrations.AlterField(
+            model_name='userbalancehistory',
+            name='amount',
+            field=models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0)]),
+        ),
+    ]
@@ -1,47 +1,332 @@
+from collections import defaultdict
 from datetime import timedelta
+from decimal import Decimal
 from django.db import models
+from django.db.models import Case, Exists, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Coalesce
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator
 from django.utils import timezone
 from django.contrib.auth import get_user_model
-from django.db import transaction
+from django.core.cache import caches
+from django.db import transaction, connection
 
 User = get_user_model()
 
+# Order state by activation ID in this process, read by the SMS webhook.
+activation_cache = caches['activations']
+# Number of balance shards by user in this process, read by debits.
+shards_cache = caches['balance_shards']
+
+
+# Balances and ledger amounts are stored as integer minor units, cents of the API's amounts.
+MINOR_UNITS = 100
+
+# First key of the PostgreSQL advisory locks taken on balances, the second one is the user id.
+BALANCE_LOCK = 1
+
+
+def to_minor(amount):
+    """Convert API amount to integer minor units."""
+    return int(round(Decimal(str(amount)) * MINOR_UNITS))
+
+
+def to_major(amount):
+    """Convert minor units to API amount."""
+    return amount / MINOR_UNITS
+
+
+class BalanceEntry(models.Model):
+    """Append-only ledger of every change to user balances, in minor units."""
+
+    class Kind(models.TextChoices):
+        OPENING = 'opening'
+        DEPOSIT = 'deposit'
+        ORDER = 'order'
+        REFUND = 'refund'
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_entries', db_index=False)
+    amount = models.BigIntegerField()
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    created_at = models.DateTimeField(default=timezone.now)
+    folded = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'id'], name='balanceentry_user_id_idx'),
+            models.Index(fields=['user'], condition=models.Q(folded=False), name='balanceentry_unfolded_idx'),
+        ]
+
+
+class BalanceShard(models.Model):
+    """Part of the funds of a user in sharded balance mode, in minor units.
+
+    Shards only allocate funds for debits, the ledger stays the balance. Debits
+    take from one shard with enough funds and skip shards locked by other
+    debits, so concurrent debits of one user do not wait on each other. Credits
+    only go to the ledger and reach the shards when they are rebalanced.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_shards', db_index=False)
+    index = models.PositiveSmallIntegerField()
+    amount = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'index'], name='balanceshard_user_index_unique'),
+        ]
+
+    @classmethod
+    def take(cls, user_id, amount):
+        """Take amount from a random unlocked shard with enough funds, return if taken."""
+        shard = (
+            cls.objects
+            .select_for_update(skip_locked=True)
+            .filter(user_id=user_id, amount__gte=amount)
+            .order_by('?')
+            .values_list('pk', flat=True)
+            .first()
+        )
+        if shard is None:
+            return False
+        cls.objects.filter(pk=shard).update(amount=F('amount') - amount)
+        return True
+
+    @classmethod
+    def lock(cls, user_id):
+        """Lock all shards of user until the end of the transaction, return their indexes."""
+        return list(cls.objects.select_for_update().filter(user_id=user_id).order_by('index')
+                    .values_list('index', flat=True))
+
+    @classmethod
+    def spread(cls, user_id, total, count):
+        """Split total evenly over count shards of user, which must be locked."""
+        share, remainder = divmod(total, count)
+        cls.objects.filter(user_id=user_id).update(amount=Case(
+            *[When(index=index, then=Value(share + (index < remainder))) for index in range(count)],
+            default=Value(0)
+        ))
+
 
 class UserBalance(models.Model):
-    """Balance for every user."""
+    """Balance for every user.
+
+    The row holds a snapshot of the user's folded ledger entries, which
+    `compact` folds in periodically. The current balance is the snapshot plus
+    the entries not folded yet, so changing a balance only inserts a
+    ledger entry and never updates this row. Credits are plain inserts; debits
+    hold a per-user lock while they check the balance and insert, unless the
+    user's funds are split into `shards` BalanceShard rows.
+    """
 
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='balance', primary_key=True)
-    amount = models.FloatField(default=0, validators=[MinValueValidator(0.0), ])
+    amount = models.BigIntegerField(default=0)
+    compacted_at = models.DateTimeField(null=True, blank=True)
+    shards = models.PositiveSmallIntegerField(default=0)
+
+    SHARDS_CACHE_TIMEOUT = 60
 
     @staticmethod
-    def update_balance(user, amount):
-        """Update balance for user."""
-        with transaction.atomic():
-            user.balance.amount += amount
-            user.balance.save()
-        return user.balance.amount
+    def current_amount():
+        """Expression for the current balance in minor units of the balance row."""
+        delta = (
+            BalanceEntry.objects
+            .filter(user_id=OuterRef('pk'), folded=False)
+            .values('user_id')
+            .annotate(total=Sum('amount'))
+            .values('total')
+        )
+        return F('amount') + Coalesce(Subquery(delta), 0)
+
+    @classmethod
+    def current_amount_of(cls, user_ref):
+        """Expression for the current balance in minor units of the user referenced by user_ref."""
+        return Subquery(cls.objects.filter(pk=user_ref).annotate(current=cls.current_amount()).values('current'))
+
+    @classmethod
+    def amount_of(cls, user):
+        """Current balance of user, taken from a balance loaded with the user if there is one.
+
+        User can be passed as an instance or as a primary key.
+        """
+        loaded = getattr(user, 'balance_amount', None)
+        if loaded is not None:
+            return to_major(loaded)
+        return to_major(cls._current(getattr(user, 'pk', user)))
+
+    @classmethod
+    def _current(cls, user_id):
+        """Current balance of user in minor units."""
+        balances = cls.objects.filter(pk=user_id).annotate(current=cls.current_amount())
+        return balances.values_list('current', flat=True).get()
 
     @staticmethod
-    def has_balance(user, amount):
-        """Check if a user has sufficient balance."""
+    def _loaded(user, amount):
+        """Keep a balance loaded with user in sync and return the balance."""
+        if isinstance(user, User) and getattr(user, 'balance_amount', None) is not None:
+            user.balance_amount = amount
+        return to_major(amount)
+
+    @classmethod
+    def _lock(cls, user_id):
+        """Serialize balance checks of user until the end of the transaction."""
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [BALANCE_LOCK, user_id % 2 ** 31])
+        else:
+            cls.objects.select_for_update().filter(pk=user_id).exists()
+
+    @classmethod
+    def debit(cls, user, amount, kind=BalanceEntry.Kind.ORDER):
+        """Take amount from user's balance if sufficient, return new balance or None.
+
+        User can be passed as an instance or as a primary key. The balance is a
+        sum over the ledger, which a single conditional INSERT ... SELECT would
+        read from its own snapshot, missing entries of concurrent uncommitted
+        debits, so two of them could overdraw. The per-user lock serializes the
+        check and the insert instead, held until commit, right after the insert
+        unless the caller's transaction is still open. Users debited too often
+        for that lock are sharded.
+        """
+        user_id = getattr(user, 'pk', user)
+        amount = to_minor(amount)
         with transaction.atomic():
-            return True if user.balance.amount >= amount else False
+            if cls.shard_count(user_id) and BalanceShard.take(user_id, amount):
+                BalanceEntry.objects.create(user_id=user_id, amount=-amount, kind=kind)
+                return cls._loaded(user, cls._current(user_id))
+
+            cls._lock(user_id)
+            balance = cls.objects.filter(pk=user_id).annotate(current=cls.current_amount())
+            current, shards = balance.values_list('current', 'shards').get()
+            if shards:
+                # No shard had enough funds, rebalance them with the debit taken out.
+                BalanceShard.lock(user_id)
+                current = cls._current(user_id)
+            if current < amount:
+                return None
+            if shards:
+                BalanceShard.spread(user_id, current - amount, shards)
+            BalanceEntry.objects.create(user_id=user_id, amount=-amount, kind=kind)
+        return cls._loaded(user, current - amount)
+
+    @classmethod
+    def shard_count(cls, user_id):
+        """Number of balance shards of user, cached for a short time in this process."""
+        key = f'balance-shards:{user_id}'
+        count = shards_cache.get(key)
+        if count is None:
+            count = cls.objects.values_list('shards', flat=True).get(pk=user_id)
+            shards_cache.set(key, count, cls.SHARDS_CACHE_TIMEOUT)
+        return count
+
+    @classmethod
+    def set_shards(cls, user_id, count):
+        """Split user's funds across count shards, 0 to stop sharding."""
+        with transaction.atomic():
+            cls._lock(user_id)
+            BalanceShard.lock(user_id)
+            BalanceShard.objects.filter(user_id=user_id, index__gte=count).delete()
+            BalanceShard.objects.bulk_create(
+                [BalanceShard(user_id=user_id, index=index) for index in range(count)], ignore_conflicts=True
+            )
+            if count:
+                BalanceShard.spread(user_id, cls._current(user_id), count)
+            cls.objects.filter(pk=user_id).update(shards=count)
+        shards_cache.delete(f'balance-shards:{user_id}')
+
+    @classmethod
+    def rebalance(cls, user_id=None):
+        """Spread the balance of sharded users evenly over their shards, including credits since the last time.
+
+        Return number of balances rebalanced.
+        """
+        balances = cls.objects.filter(shards__gt=0)
+        if user_id is not None:
+            balances = balances.filter(pk=user_id)
+        rebalanced = 0
+        for user_id, shards in balances.values_list('pk', 'shards'):
+            with transaction.atomic():
+                if BalanceShard.lock(user_id):
+                    BalanceShard.spread(user_id, cls._current(user_id), shards)
+                    rebalanced += 1
+        return rebalanced
+
+    @classmethod
+    def credit(cls, user, amount, kind=BalanceEntry.Kind.REFUND):
+        """Add amount to user's balance and return new balance."""
+        user_id = getattr(user, 'pk', user)
+        BalanceEntry.objects.create(user_id=user_id, amount=to_minor(amount), kind=kind)
+        return cls._loaded(user, cls._current(user_id))
+
+    @classmethod
+    def credit_many(cls, amounts, kind=BalanceEntry.Kind.REFUND):
+        """Add amounts to several balances with one INSERT, amounts maps user id to amount in minor units."""
+        entries = BalanceEntry.objects.bulk_create([
+            BalanceEntry(user_id=user_id, amount=amount, kind=kind) for user_id, amount in amounts.items()
+        ])
+        return len(entries)
+
+    @classmethod
+    def compact(cls, lag=timedelta(minutes=1), batch_size=5000):
+        """Fold ledger entries older than lag into the snapshots, return number of balance updates.
+
+        Each batch locks committed entries not folded yet, marks them folded and
+        adds them to their snapshots in one transaction, so an entry is counted
+        exactly once however late it commits. Entries locked by another
+        compaction are skipped.
+        """
+        cutoff = timezone.now() - lag
+        updated = 0
+        while True:
+            with transaction.atomic():
+                ids = list(
+                    BalanceEntry.objects.select_for_update(skip_locked=True)
+                    .filter(folded=False, created_at__lt=cutoff)
+                    .order_by('id')
+                    .values_list('id', flat=True)[:batch_size]
+                )
+                if not ids:
+                    return updated
+                BalanceEntry.objects.filter(id__in=ids).update(folded=True)
+                batch = BalanceEntry.objects.filter(id__in=ids, user_id=OuterRef('pk'))
+                updated += cls.objects.filter(Exists(batch)).update(
+                    amount=F('amount') + Subquery(batch.values('user_id').annotate(total=Sum('amount')).values('total')),
+                    compacted_at=timezone.now()
+                )
+            if len(ids) < batch_size:
+                return updated
+
+    @classmethod
+    def reconcile(cls):
+        """Return (user id, snapshot, ledger sum) of balances whose snapshot does not match the ledger."""
+        ledger = (
+            BalanceEntry.objects
+            .filter(user_id=OuterRef('pk'), folded=True)
+            .values('user_id')
+            .annotate(total=Sum('amount'))
+            .values('total')
+        )
+        return list(
+            cls.objects.annotate(ledger=Coalesce(Subquery(ledger), 0))
+            .exclude(amount=F('ledger'))
+            .values_list('pk', 'amount', 'ledger')
+        )
 
 
 class UserBalanceHistory(models.Model):
-    """Balance history for every user."""
+    """Balance history for every user, amounts in minor units."""
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='balance_history')
     created_at = models.DateTimeField(default=timezone.now)
-    amount = models.FloatField(validators=[MinValueValidator(0.0), ])
+    amount = models.BigIntegerField(validators=[MinValueValidator(0), ])
 
 
 class Order(models.Model):
-    """User orders."""
+    """User orders, amounts in minor units."""
 
     class NumberStatus(models.TextChoices):
+        PLACING = _('placing')
         SMS_PENDING = _('sms pending')
         SUCCESS = _('success')
         FINISHED = _('finished')
@@ -55,38 +340,125 @@ class Order(models.Model):
     number = models.CharField(max_length=30, blank=True, null=True)
     status = models.CharField(max_length=15, choices=NumberStatus.choices, default=NumberStatus.SMS_PENDING)
     created_at = models.DateTimeField(default=timezone.now)
-    amount = models.FloatField(validators=[MinValueValidator(0.0), ])
+    amount = models.BigIntegerField(validators=[MinValueValidator(0), ])
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'status', 'created_at'], name='order_user_status_created_idx'),
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['activation_id'], name='order_activation_id_unique'),
+        ]
+
+    EXPIRY = timedelta(minutes=20)
+    ACTIVATION_CACHE_TIMEOUT = 60 * 60
+
+    @staticmethod
+    def activation_key(activation_id):
+        """Activation cache key for activation ID."""
+        return f'activation:{activation_id}'
+
+    def cache_state(self):
+        """Cache fields needed by the SMS webhook under the order's activation ID."""
+        if self.activation_id:
+            activation_cache.set(
+                self.activation_key(self.activation_id),
+                (self.pk, self.user_id, self.amount, self.status, self.created_at),
+                self.ACTIVATION_CACHE_TIMEOUT
+            )
+
+    @classmethod
+    def forget_states(cls, activation_ids):
+        """Drop cached states so they are read from the database next time."""
+        activation_cache.delete_many([cls.activation_key(activation_id) for activation_id in activation_ids if activation_id])
+
+    @classmethod
+    def get_by_activation_id(cls, activation_id):
+        """Get order by activation ID, from the activation cache if possible.
+
+        A cached order only has the fields needed to apply an SMS. Its status may
+        be stale in a way that is safe: terminal states never change and
+        transitions from a live state are conditional on the database status.
+        """
+        state = activation_cache.get(cls.activation_key(activation_id))
+        if state is not None:
+            pk, user_id, amount, status, created_at = state
+            return cls(pk=pk, user_id=user_id, amount=amount, status=status, created_at=created_at,
+                       activation_id=activation_id)
+
+        order = cls.objects.get(activation_id=activation_id)
+        order.cache_state()
+        return order
+
+    def has_expired(self, at=None):
+        """Check if 20 minutes has been passed since order creation, now or at the given time."""
+        return self.created_at + self.EXPIRY < (at or timezone.now())
+
+    @classmethod
+    def expire_overdue(cls, batch_size=1000):
+        """Expire a batch of overdue pending orders and refund them, return number expired.
+
+        Orders still placing, left behind by a bulk order that did not finish,
+        are expired and refunded the same way.
+
+        Orders are marked expired with one UPDATE and balances are refunded with
+        one grouped UPDATE. Rows locked by a concurrent cancel or SMS push are
+        skipped and picked up by the next run if still pending, as are orders
+        with an SMS waiting in the inbox, which decides by when it was received.
+        """
+        cutoff = timezone.now() - cls.EXPIRY
+        with transaction.atomic():
+            overdue = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status__in=[cls.NumberStatus.SMS_PENDING, cls.NumberStatus.PLACING], created_at__lt=cutoff)
+                .exclude(Exists(SMSInbox.queued().filter(activation_id=OuterRef('activation_id'))))
+                .order_by('created_at')
+                .values_list('id', 'user_id', 'amount', 'activation_id')[:batch_size]
+            )
+            if not overdue:
+                return 0
 
-    def has_expired(self):
-        """Check if 20 minutes has been passed since order creation."""
-        return self.created_at + timedelta(minutes=20) < timezone.now()
+            cls.objects.filter(id__in=[order_id for order_id, _, _, _ in overdue]).update(
+                status=cls.NumberStatus.EXPIRED
+            )
+            refunds = defaultdict(int)
+            for _, user_id, amount, _ in overdue:
+                refunds[user_id] += amount
+            UserBalance.credit_many(refunds)
+        cls.forget_states([activation_id for _, _, _, activation_id in overdue])
+        return len(overdue)
+
+    def transition(self, from_states, to_state):
+        """Move order to to_state if it is still in one of from_states.
+
+        Runs a single conditional UPDATE touching only status, so of two concurrent
+        transitions only one can win. Return True if this call won.
+        """
+        won = Order.objects.filter(pk=self.pk, status__in=from_states).update(status=to_state) == 1
+        if won:
+            self.status = to_state
+            transaction.on_commit(self.cache_state)
+        else:
+            self.forget_states([self.activation_id])
+        return won
 
     def cancel(self):
         """Cancel order if not expired, otherwise expire order."""
-        amount = self.user.balance.amount
-        status = self.NumberStatus.CANCELLED
-
-        if self.status != self.NumberStatus.SMS_PENDING:
-            return amount, self.status
-        if self.has_expired():
-            status = self.NumberStatus.EXPIRED
+        status = self.NumberStatus.EXPIRED if self.has_expired() else self.NumberStatus.CANCELLED
 
         with transaction.atomic():
-            self.status = status
-            self.save()
-        amount = UserBalance.update_balance(self.user, self.amount)
-        print(amount)
-        return amount, self.status
+            if self.transition([self.NumberStatus.SMS_PENDING], status):
+                return UserBalance.credit(self.user_id, to_major(self.amount)), self.status
+
+        self.refresh_from_db(fields=['status'])
+        return UserBalance.amount_of(self.user_id), self.status
 
     def finish(self):
         """Finish an order."""
-        if self.status != self.NumberStatus.SUCCESS:
-            return self.status
-        if self.status == self.NumberStatus.FINISHED:
-            return self.status
-        with transaction.atomic():
-            self.status = self.NumberStatus.FINISHED
-            self.save()
+        if not self.transition([self.NumberStatus.SUCCESS], self.NumberStatus.FINISHED):
+            self.refresh_from_db(fields=['status'])
+        return self.status
 
 
 class OrderSMS(models.Model):
@@ -94,9 +466,64 @@ class OrderSMS(models.Model):
 
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='sms_codes')
     sms_code = models.CharField(max_length=255, null=True, blank=True)
+    digest = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['digest'], name='ordersms_digest_unique'),
+        ]
 
 
 class SMSHistory(models.Model):
-    """Record history of SMS codes received by third party."""
+    """Record history of SMS codes received by third party.
+
+    Stored in a table partitioned by month of received_at, see orders.partitions.
+    """
 
     request_data = models.JSONField()
+    received_at = models.DateTimeField(default=timezone.now)
+
+
+class SMSInbox(models.Model):
+    """SMS pushed by third party waiting to be applied to orders by the inbox worker.
+
+    SMS that could not be applied are kept with failed_at and last_error set.
+    """
+
+    payload = models.JSONField()
+    received_at = models.DateTimeField(default=timezone.now)
+    failed_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(KeyTextTransform('activationId', 'payload'), condition=models.Q(failed_at__isnull=True),
+                         name='smsinbox_activation_id_idx'),
+        ]
+
+    @classmethod
+    def queued(cls):
+        """SMS waiting to be applied, annotated with the activation ID of their order."""
+        return cls.objects.filter(failed_at__isnull=True).annotate(
+            activation_id=KeyTextTransform('activationId', 'payload')
+        )
+
+
+class EmailOutbox(models.Model):
+    """Email waiting to be sent by the outbox worker, kept after sending."""
+
+    sender = models.CharField(max_length=254)
+    receiver = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255)
+    html = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now, null=True, blank=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(sent_at__isnull=True),
+                         name='emailoutbox_pending_idx'),
+        ]
@@ -0,0 +1,93 @@
+"""Monthly partitions of the SMS history table.
+
+SMS history is stored in a table partitioned by range of `received_at`, with
+one partition per month and a default partition catching rows for months that
+have no partition yet. Old months are removed by detaching and dropping their
+partition instead of deleting rows. Only PostgreSQL is supported.
+"""
+
+import re
+from datetime import datetime, timezone
+
+TABLE = 'orders_smshistory'
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_NAME = re.compile(rf'^{TABLE}_p(\d{{4}})_(\d{{2}})$')
+
+
+def month_start(moment, months=0):
+    """Start of the month `months` away from the month of moment, in UTC."""
+    month_index = moment.year * 12 + moment.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start):
+    """Name of the partition holding the month starting at start."""
+    return f'{TABLE}_p{start:%Y_%m}'
+
+
+def existing_partitions(cursor):
+    """Map month start to partition name for every monthly partition."""
+    cursor.execute(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'WHERE parent.relname = %s',
+        [TABLE]
+    )
+    partitions = {}
+    for name, in cursor.fetchall():
+        match = PARTITION_NAME.match(name)
+        if match:
+            partitions[datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)] = name
+    return partitions
+
+
+def create_partition(cursor, start):
+    """Create partition for the month starting at start.
+
+    Rows of that month already stored in the default partition are moved to
+    the new partition, which PostgreSQL requires before it can be attached.
+    """
+    end = month_start(start, 1)
+    name = partition_name(start)
+    cursor.execute(f'SELECT 1 FROM "{DEFAULT_PARTITION}" WHERE received_at >= %s AND received_at < %s LIMIT 1',
+                   [start, end])
+    if cursor.fetchone() is None:
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "{TABLE}" FOR VALUES FROM (%s) TO (%s)',
+                       [start, end])
+        return name
+
+    cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{DEFAULT_PARTITION}"')
+    cursor.execute(f'CREATE TABLE "{name}" PARTITION OF "{TABLE}" FOR VALUES FROM (%s) TO (%s)', [start, end])
+    cursor.execute(
+        f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" WHERE received_at >= %s AND received_at < %s RETURNING *) '
+        f'INSERT INTO "{TABLE}" SELECT * FROM moved',
+        [start, end]
+    )
+    cursor.execute(f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{DEFAULT_PARTITION}" DEFAULT')
+    return name
+
+
+def create_partitions(cursor, now, ahead):
+    """Create partitions from the current month up to `ahead` months later, return created names."""
+    existing = existing_partitions(cursor)
+    created = []
+    for months in range(ahead + 1):
+        start = month_start(now, months)
+        if start not in existing:
+            created.append(create_partition(cursor, start))
+    return created
+
+
+def remove_partitions(cursor, now, retain, archive=False):
+    """Detach partitions older than `retain` months and drop them unless archiving, return their names."""
+    cutoff = month_start(now, -retain)
+    removed = []
+    for start, name in sorted(existing_partitions(cursor).items()):
+        if start >= cutoff:
+            continue
+        cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+        if not archive:
+            cursor.execute(f'DROP TABLE "{name}"')
+        removed.append(name)
+    return removed
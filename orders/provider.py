@@ -0,0 +1,203 @@
+"""Client for the third party number provider.
+
+A single client is shared by every view in a worker so connections to the
+provider are kept alive and reused. Calls are bounded by connect and read
+timeouts, connection failures are retried with backoff and a circuit breaker
+fails fast while the provider is down. Async views use the same client through
+`aorder_number`, which is backed by an httpx connection pool.
+"""
+
+import asyncio
+import os
+import threading
+import time
+
+import environ
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+env = environ.Env()
+environ.Env.read_env()
+
+
+class ProviderError(Exception):
+    """Provider could not be reached or did not answer in time."""
+
+
+class ProviderUnavailable(ProviderError):
+    """Provider is considered down and calls are short-circuited."""
+
+
+class CircuitBreaker:
+    """Stop calling the provider after repeated failures.
+
+    After `failure_threshold` consecutive failures the breaker opens and every
+    call is rejected for `reset_timeout` seconds. Once that time passes a single
+    probe call is let through; its outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        """Check if calls are currently being rejected."""
+        with self._lock:
+            return self._opened_at is not None and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def allow(self):
+        """Check if a call may be made now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Half open, re-arm the timer so only this call probes the provider.
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        """Close the breaker after a successful call."""
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        """Count a failed call and open the breaker if threshold is reached."""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class ProviderClient:
+    """Pooled, timeout bounded HTTP client for ordering numbers."""
+
+    def __init__(self, url=None, connect_timeout=None, read_timeout=None, retries=None,
+                 backoff_factor=None, pool_size=None, async_pool_size=None, breaker=None):
+        self._url = url
+        self.connect_timeout = connect_timeout or env.float('ORDER_API_CONNECT_TIMEOUT', default=3.05)
+        self.read_timeout = read_timeout or env.float('ORDER_API_READ_TIMEOUT', default=15)
+        self.retries = env.int('ORDER_API_RETRIES', default=2) if retries is None else retries
+        self.backoff_factor = backoff_factor or env.float('ORDER_API_BACKOFF', default=0.2)
+        self.pool_size = pool_size or env.int('ORDER_API_POOL_SIZE', default=10)
+        self.async_pool_size = async_pool_size or env.int('ORDER_API_ASYNC_POOL_SIZE', default=200)
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=env.int('ORDER_API_BREAKER_THRESHOLD', default=5),
+            reset_timeout=env.float('ORDER_API_BREAKER_RESET', default=30),
+        )
+        self._session = None
+        self._session_pid = None
+        self._async_client = None
+        self._async_client_loop = None
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        """Order endpoint of the provider."""
+        return self._url or env('ORDER_API')
+
+    @property
+    def timeout(self):
+        """Connect and read timeout passed to requests."""
+        return self.connect_timeout, self.read_timeout
+
+    def _build_session(self):
+        """Create session with keep-alive pool and retries for connection failures."""
+        # Only connection errors are retried: the request never reached the provider
+        # so retrying can not buy a second number.
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def session(self):
+        """Session for this worker process, rebuilt after a fork."""
+        pid = os.getpid()
+        if self._session is None or self._session_pid != pid:
+            with self._lock:
+                if self._session is None or self._session_pid != pid:
+                    self._session = self._build_session()
+                    self._session_pid = pid
+        return self._session
+
+    def _build_async_client(self):
+        """Create async client with keep-alive pool and retries for connection failures."""
+        transport = httpx.AsyncHTTPTransport(
+            retries=self.retries,
+            limits=httpx.Limits(max_connections=self.async_pool_size,
+                                max_keepalive_connections=self.async_pool_size),
+        )
+        return httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+        )
+
+    @property
+    def async_client(self):
+        """Async client bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_client_loop is not loop:
+            self._async_client = self._build_async_client()
+            self._async_client_loop = loop
+        return self._async_client
+
+    def _record(self, status_code):
+        """Feed the outcome of a call to the circuit breaker."""
+        if status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def order_number(self, service, country):
+        """Order a number from the provider and return the raw response.
+
+        Raises ProviderUnavailable without calling the provider while the circuit
+        is open and ProviderError when the provider could not be reached in time.
+        """
+        if not self.breaker.allow():
+            raise ProviderUnavailable('Number provider is temporarily unavailable.')
+
+        try:
+            response = self.session.post(self.url, json={'service': service, 'country': country},
+                                         timeout=self.timeout)
+        except requests.RequestException as e:
+            self.breaker.record_failure()
+            raise ProviderError(str(e)) from e
+
+        self._record(response.status_code)
+        return response
+
+    async def aorder_number(self, service, country):
+        """Async version of `order_number`, returns an httpx response."""
+        if not self.breaker.allow():
+            raise ProviderUnavailable('Number provider is temporarily unavailable.')
+
+        try:
+            response = await self.async_client.post(self.url, json={'service': service, 'country': country})
+        except httpx.HTTPError as e:
+            self.breaker.record_failure()
+            raise ProviderError(str(e)) from e
+
+        self._record(response.status_code)
+        return response
+
+
+provider = ProviderClient()
@@ -1,12 +1,24 @@
 """Serializers for orders."""
 
 from rest_framework import serializers
-from orders.models import UserBalance, UserBalanceHistory, Order, OrderSMS
+from orders.models import UserBalanceHistory, Order, OrderSMS, to_major, to_minor
+
+
+class MinorUnitsField(serializers.FloatField):
+    """Amount given and shown in API units and stored in integer minor units."""
+
+    def to_internal_value(self, data):
+        return to_minor(super().to_internal_value(data))
+
+    def to_representation(self, value):
+        return to_major(value)
 
 
 class CreateOrderSerializer(serializers.ModelSerializer):
     """Create order for user."""
 
+    amount = MinorUnitsField(min_value=0)
+
     class Meta:
         model = Order
         fields = ['country', 'service', 'user', 'amount', ]
@@ -15,26 +27,28 @@ class CreateOrderSerializer(serializers.ModelSerializer):
 class ListOrderSerializer(serializers.ModelSerializer):
     """Create order for user."""
     sms_codes = serializers.SerializerMethodField()
+    amount = MinorUnitsField(read_only=True)
 
     def get_sms_codes(self, obj):
-        return obj.sms_codes.values_list('sms_code', flat=True)
+        """Codes are prefetched by list views, so no query is made per order."""
+        return [sms.sms_code for sms in obj.sms_codes.all()]
 
     class Meta:
         model = Order
         fields = ['id', 'country', 'service', 'activation_id', 'number', 'status', 'created_at', 'amount', 'sms_codes']
 
 
-class UserBalanceAddSerializer(serializers.ModelSerializer):
+class UserBalanceAddSerializer(serializers.Serializer):
     """Add User balance."""
 
-    class Meta:
-        model = UserBalance
-        fields = ['amount', ]
+    amount = serializers.FloatField(min_value=0.0)
 
 
 class UserBalanceHistorySerializer(serializers.ModelSerializer):
     """User's balance history."""
 
+    amount = MinorUnitsField(read_only=True)
+
     class Meta:
         model = UserBalanceHistory
         fields = ['created_at', 'amount', ]
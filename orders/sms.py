@@ -0,0 +1,191 @@
+"""Apply SMS codes pushed by the third party service to orders."""
+
+from collections import defaultdict
+from hashlib import sha256
+
+from django.core.cache import caches
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.status import (
+    HTTP_200_OK,
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_500_INTERNAL_SERVER_ERROR
+)
+
+from orders.models import Order, OrderSMS, SMSHistory, SMSInbox, UserBalance
+
+# Digests of SMS recently applied by this process, repeat deliveries are answered from here.
+recent_sms = caches['recent_sms']
+RECENT_SMS_TIMEOUT = 60 * 60
+
+ACTIVATION_ID_MAX_LENGTH = Order._meta.get_field('activation_id').max_length
+SMS_CODE_MAX_LENGTH = OrderSMS._meta.get_field('sms_code').max_length
+
+MESSAGES = {
+    'missing': 'Missing parameters',
+    'invalid': f'activationId must be a string or number of at most {ACTIVATION_ID_MAX_LENGTH} characters '
+               f'and text a string of at most {SMS_CODE_MAX_LENGTH} characters',
+    'duplicate': 'SMS code has already been received',
+    'not_found': 'Order not found against activation ID',
+    Order.NumberStatus.CANCELLED: 'Order has already been cancelled',
+    Order.NumberStatus.FINISHED: 'Order has already been finished',
+    Order.NumberStatus.EXPIRED: '20 minutes have already passed after order creation',
+    Order.NumberStatus.SUCCESS: 'SMS code added to order',
+}
+
+
+def event_error(event):
+    """Message key of what is wrong with event, None if it can be applied."""
+    if not isinstance(event, dict) or 'activationId' not in event or 'text' not in event:
+        return 'missing'
+    activation_id, text = event['activationId'], event['text']
+    if isinstance(activation_id, bool) or not isinstance(activation_id, (str, int)) \
+            or len(str(activation_id)) > ACTIVATION_ID_MAX_LENGTH:
+        return 'invalid'
+    if not isinstance(text, str) or len(text) > SMS_CODE_MAX_LENGTH:
+        return 'invalid'
+    return None
+
+
+def sms_digest(activation_id, text):
+    """Key identifying one SMS delivery for deduplication."""
+    return sha256(f'{activation_id}\x00{text}'.encode()).hexdigest()
+
+
+def seen_recently(digest):
+    """Check if SMS with this digest was applied recently by this process."""
+    return recent_sms.get(f'sms:{digest}') is not None
+
+
+def remember(digests):
+    """Remember digests of applied SMS so repeat deliveries skip the database."""
+    recent_sms.set_many({f'sms:{digest}': True for digest in digests}, RECENT_SMS_TIMEOUT)
+
+
+def result(event, status, message_key):
+    """Result of applying one event."""
+    activation_id = event.get('activationId') if isinstance(event, dict) else None
+    if not isinstance(activation_id, (str, int)) or len(str(activation_id)) > ACTIVATION_ID_MAX_LENGTH:
+        activation_id = None
+    return {'activationId': activation_id, 'status': status, 'message': MESSAGES[message_key]}
+
+
+def apply_sms_batch(events, record_history=False, received_at=None):
+    """Apply SMS events to their orders in one transaction, return a result per event.
+
+    Orders are fetched with one IN query, pending orders are moved to success
+    and overdue ones expired with one UPDATE each, and SMS codes (plus history
+    rows if record_history is set) are inserted with bulk_create. Events whose
+    SMS was already stored, in this batch or before, are reported as duplicates.
+    Expiry is judged at received_at, a time per event, or now if not given.
+    """
+    now = timezone.now()
+    results, digests = [], {}
+    for index, event in enumerate(events):
+        error = event_error(event)
+        if error:
+            results.append(result(event, HTTP_400_BAD_REQUEST, error))
+            continue
+        digest = sms_digest(event['activationId'], event['text'])
+        if digest in digests or seen_recently(digest):
+            results.append(result(event, HTTP_200_OK, 'duplicate'))
+            continue
+        digests[digest] = index
+        results.append(None)
+
+    with transaction.atomic():
+        if record_history:
+            SMSHistory.objects.bulk_create([SMSHistory(request_data=event) for event in events])
+
+        stored = set(OrderSMS.objects.filter(digest__in=digests.keys()).values_list('digest', flat=True))
+        for digest in stored:
+            index = digests.pop(digest)
+            results[index] = result(events[index], HTTP_200_OK, 'duplicate')
+
+        orders = Order.objects.select_for_update().in_bulk(
+            {str(events[index]['activationId']) for index in digests.values()}, field_name='activation_id'
+        )
+        to_success, to_expire, codes = set(), {}, []
+        for digest, index in digests.items():
+            event = events[index]
+            order = orders.get(str(event['activationId']))
+            if order is None:
+                results[index] = result(event, HTTP_404_NOT_FOUND, 'not_found')
+            elif order.status in (Order.NumberStatus.CANCELLED, Order.NumberStatus.FINISHED):
+                results[index] = result(event, HTTP_200_OK, order.status)
+            elif order.has_expired(received_at[index] if received_at else now) \
+                    or order.status == Order.NumberStatus.EXPIRED:
+                if order.status == Order.NumberStatus.SMS_PENDING:
+                    to_expire[order.pk] = order
+                results[index] = result(event, HTTP_200_OK, Order.NumberStatus.EXPIRED)
+            else:
+                if order.status == Order.NumberStatus.SMS_PENDING:
+                    to_success.add(order.pk)
+                codes.append(OrderSMS(order=order, sms_code=event.get('text', ''), digest=digest))
+                results[index] = result(event, HTTP_200_OK, Order.NumberStatus.SUCCESS)
+
+        for order in orders.values():
+            if order.pk in to_success:
+                order.status = Order.NumberStatus.SUCCESS
+            elif order.pk in to_expire:
+                order.status = Order.NumberStatus.EXPIRED
+            transaction.on_commit(order.cache_state)
+
+        if to_success:
+            Order.objects.filter(pk__in=to_success).update(status=Order.NumberStatus.SUCCESS)
+        if to_expire:
+            Order.objects.filter(pk__in=to_expire.keys()).update(status=Order.NumberStatus.EXPIRED)
+            refunds = defaultdict(int)
+            for order in to_expire.values():
+                refunds[order.user_id] += order.amount
+            UserBalance.credit_many(refunds)
+        if codes:
+            # A concurrent delivery of the same SMS may have been stored meanwhile.
+            OrderSMS.objects.bulk_create(codes, ignore_conflicts=True)
+
+    remember(stored | {code.digest for code in codes})
+    return results
+
+
+def apply_queued(message):
+    """Apply one queued SMS on its own, return its result, an error result if it can not be stored."""
+    try:
+        with transaction.atomic():
+            return apply_sms_batch([message.payload], received_at=[message.received_at])[0]
+    except (DataError, IntegrityError) as e:
+        return {'activationId': None, 'status': HTTP_500_INTERNAL_SERVER_ERROR, 'message': f'{type(e).__name__}: {e}'}
+
+
+def drain_inbox(batch_size=500):
+    """Apply a batch of queued SMS and remove them from the inbox, return number processed.
+
+    Rows are locked with SKIP LOCKED so several workers can drain the inbox
+    side by side, and are only removed once their batch is applied. If the
+    batch can not be stored its SMS are applied one at a time. SMS that are
+    invalid or still fail stay in the inbox marked failed, so they do not
+    block the ones queued after them.
+    """
+    with transaction.atomic():
+        queued = list(
+            SMSInbox.objects.select_for_update(skip_locked=True)
+            .filter(failed_at__isnull=True)
+            .order_by('id')[:batch_size]
+        )
+        if not queued:
+            return 0
+        try:
+            with transaction.atomic():
+                results = apply_sms_batch([message.payload for message in queued],
+                                          received_at=[message.received_at for message in queued])
+        except (DataError, IntegrityError):
+            results = [apply_queued(message) for message in queued]
+
+        failed = []
+        for message, result in zip(queued, results):
+            if result['status'] in (HTTP_400_BAD_REQUEST, HTTP_500_INTERNAL_SERVER_ERROR):
+                message.failed_at, message.last_error = timezone.now(), result['message']
+                failed.append(message)
+        SMSInbox.objects.bulk_update(failed, ['failed_at', 'last_error'])
+        SMSInbox.objects.filter(id__in=[message.id for message in queued if message.failed_at is None]).delete()
+    return len(queued)
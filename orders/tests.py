@@ -1,3 +1,717 @@
-from django.test import TestCase
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.cache import cache
+from django.db import DataError, IntegrityError
+from django.test import TestCase, TransactionTestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from urllib3.util.retry import Retry
+
+from orders import idempotency
+from orders.audit import SMSHistoryBuffer
+from orders.mail import DjangoMailBackend, SendGridBackend, send_outbox
+from orders.provider import CircuitBreaker, ProviderClient, ProviderError, ProviderUnavailable
+from orders.models import (
+    BalanceEntry,
+    BalanceShard,
+    EmailOutbox,
+    Order,
+    OrderSMS,
+    SMSHistory,
+    SMSInbox,
+    UserBalance,
+    UserBalanceHistory,
+    activation_cache
+)
+from orders.sms import MESSAGES, apply_sms_batch, drain_inbox, recent_sms
+from orders.utils import send_emails
+from orders.views import CreateBulkOrderView
+from simswitch.testing import StubHandler, StubServerMixin
+from users.models import UserAPIKey
+from users.throttling import MemoryBucketStore, UserOrderThrottle
+
+
+class ListOrderQueriesTest(TestCase):
+    """Order list endpoints should not make a query per order."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('user@example.com', 'password')
+        cls.token = Token.objects.create(user=cls.user)
+        for status in [Order.NumberStatus.SMS_PENDING, Order.NumberStatus.SUCCESS, Order.NumberStatus.FINISHED]:
+            order = Order.objects.create(user=cls.user, country='us', service='tg', amount=100, status=status)
+            OrderSMS.objects.create(order=order, sms_code='1234')
+            OrderSMS.objects.create(order=order, sms_code='5678')
+
+    def list_orders(self, url_name):
+        """Fetch order list with a fixed number of queries."""
+        # Token with user and balance, orders, prefetched SMS codes.
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse(url_name), HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_list_orders(self):
+        data = self.list_orders('orders:list-orders')
+        self.assertEqual(data['balance'], 0)
+        self.assertEqual(len(data['orders']), 3)
+        self.assertEqual(data['orders'][0]['sms_codes'], ['1234', '5678'])
+
+    def test_list_active_orders(self):
+        data = self.list_orders('orders:list-active-orders')
+        self.assertEqual(len(data['orders']), 2)
+
+
+class ListOrderPaginationTest(TestCase):
+    """Order list is paginated newest first with a cursor."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('user@example.com', 'password')
+        cls.token = Token.objects.create(user=cls.user)
+        created_at = timezone.now()
+        cls.orders = [
+            Order.objects.create(user=cls.user, country='us', service='tg', amount=100, created_at=created_at)
+            for _ in range(5)
+        ]
+
+    def test_pages_follow_cursor(self):
+        url = reverse('orders:list-orders') + '?page_size=2'
+        ids = []
+        while url:
+            response = self.client.get(url, HTTP_AUTHORIZATION=f'Token {self.token.key}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('balance', response.data)
+            ids.extend(order['id'] for order in response.data['orders'])
+            url = response.data['next']
+        self.assertEqual(ids, [order.id for order in reversed(self.orders)])
+
+    def test_balance_history_stays_a_list(self):
+        for amount in range(3):
+            UserBalanceHistory.objects.create(user=self.user, amount=amount * 100)
+        response = self.client.get(reverse('orders:balance-history') + '?page_size=2',
+                                   HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual([deposit['amount'] for deposit in response.data], [2, 1])
+        next_link = response['Link'].removeprefix('<').removesuffix('>; rel="next"')
+        response = self.client.get(next_link, HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual([deposit['amount'] for deposit in response.data], [0])
+        self.assertFalse(response.has_header('Link'))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('orders:list-orders') + '?cursor=invalid',
+                                   HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 404)
+
+
+class ActivationCacheTest(TestCase):
+    """Orders looked up by activation ID are served from the activation cache."""
+
+    def setUp(self):
+        activation_cache.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.order = Order.objects.create(user=self.user, country='us', service='tg', amount=100,
+                                          activation_id='123', status=Order.NumberStatus.SUCCESS)
+
+    def test_lookup_is_cached(self):
+        Order.get_by_activation_id('123')
+        with self.assertNumQueries(0):
+            order = Order.get_by_activation_id('123')
+        self.assertEqual((order.pk, order.status), (self.order.pk, Order.NumberStatus.SUCCESS))
+
+    def test_transition_updates_cache(self):
+        Order.get_by_activation_id('123')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order.finish()
+        with self.assertNumQueries(0):
+            self.assertEqual(Order.get_by_activation_id('123').status, Order.NumberStatus.FINISHED)
+
+
+class OrderTransitionTest(TestCase):
+    """Of two concurrent transitions of an order only the first one takes effect."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        UserBalance.credit(self.user, 10, kind=BalanceEntry.Kind.DEPOSIT)
+        self.order = Order.objects.create(user=self.user, country='us', service='tg', amount=100, activation_id='1')
+
+    def test_stale_cancel_loses(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        self.assertTrue(self.order.transition([Order.NumberStatus.SMS_PENDING], Order.NumberStatus.SUCCESS))
+        self.assertEqual(stale.status, Order.NumberStatus.SMS_PENDING)
+
+        self.assertFalse(stale.transition([Order.NumberStatus.SMS_PENDING], Order.NumberStatus.CANCELLED))
+        self.assertEqual(stale.cancel(), (10, Order.NumberStatus.SUCCESS))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.NumberStatus.SUCCESS)
+        self.assertEqual(BalanceEntry.objects.count(), 1)
+
+
+class ExpireOverdueTest(TestCase):
+    """Overdue pending orders are expired and refunded with one ledger entry per user."""
+
+    def setUp(self):
+        self.users = [get_user_model().objects.create_user(f'user{index}@example.com', 'password')
+                      for index in range(2)]
+        overdue = timezone.now() - timedelta(minutes=30)
+        for user, amount, created_at, activation_id in [
+            (self.users[0], 100, overdue, '1'),
+            (self.users[0], 250, overdue, '2'),
+            (self.users[1], 50, overdue, '3'),
+            (self.users[1], 70, timezone.now(), '4'),
+            (self.users[1], 80, overdue, '5'),
+        ]:
+            Order.objects.create(user=user, country='us', service='tg', amount=amount, created_at=created_at,
+                                 activation_id=activation_id)
+        SMSInbox.objects.create(payload={'activationId': '5', 'text': 'a'}, received_at=overdue)
+
+    def test_expire_overdue(self):
+        self.assertEqual(Order.expire_overdue(), 3)
+        self.assertEqual(dict(Order.objects.values_list('activation_id', 'status')), {
+            '1': Order.NumberStatus.EXPIRED,
+            '2': Order.NumberStatus.EXPIRED,
+            '3': Order.NumberStatus.EXPIRED,
+            '4': Order.NumberStatus.SMS_PENDING,
+            '5': Order.NumberStatus.SMS_PENDING,
+        })
+        self.assertEqual(sorted(BalanceEntry.objects.values_list('user_id', 'amount', 'kind')), [
+            (self.users[0].pk, 350, BalanceEntry.Kind.REFUND),
+            (self.users[1].pk, 50, BalanceEntry.Kind.REFUND),
+        ])
+        self.assertEqual(Order.expire_overdue(), 0)
+
+
+class ApplySMSBatchTest(TestCase):
+    """SMS batches apply codes, skip duplicates and refund orders that expired."""
+
+    def setUp(self):
+        activation_cache.clear()
+        recent_sms.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.pending = Order.objects.create(user=self.user, country='us', service='tg', amount=100, activation_id='1')
+        self.overdue = Order.objects.create(user=self.user, country='us', service='tg', amount=200, activation_id='2',
+                                            created_at=timezone.now() - timedelta(minutes=30))
+
+    def test_apply_batch(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            results = apply_sms_batch([
+                {'activationId': '1', 'text': 'a'},
+                {'activationId': '1', 'text': 'a'},
+                {'activationId': 1, 'text': 'b'},
+                {'activationId': '2', 'text': 'c'},
+                {'activationId': '3', 'text': 'd'},
+                {'activationId': '1', 'text': 'x' * 256},
+                {'activationId': ['1'], 'text': 'e'},
+                {'text': 'f'},
+            ])
+        self.assertEqual([(result['activationId'], result['status']) for result in results], [
+            ('1', 200), ('1', 200), (1, 200), ('2', 200), ('3', 404), ('1', 400), (None, 400), (None, 400)
+        ])
+        self.assertEqual(results[1]['message'], MESSAGES['duplicate'])
+        self.assertEqual(results[3]['message'], MESSAGES[Order.NumberStatus.EXPIRED])
+        self.assertEqual(sorted(OrderSMS.objects.values_list('sms_code', flat=True)), ['a', 'b'])
+        self.assertEqual(Order.get_by_activation_id('1').status, Order.NumberStatus.SUCCESS)
+        self.overdue.refresh_from_db()
+        self.assertEqual(self.overdue.status, Order.NumberStatus.EXPIRED)
+        self.assertEqual(UserBalance.amount_of(self.user), 2)
+
+        activation_cache.clear()
+        results = apply_sms_batch([{'activationId': '1', 'text': 'a'}])
+        self.assertEqual(results[0]['message'], MESSAGES['duplicate'])
+        self.assertEqual(OrderSMS.objects.count(), 2)
+
+
+class UpdateSMSViewTest(TestCase):
+    """A single SMS pushed twice is recorded once."""
+
+    def setUp(self):
+        activation_cache.clear()
+        recent_sms.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.order = Order.objects.create(user=self.user, country='us', service='tg', amount=100, activation_id='1')
+        for patcher in [mock.patch.dict(os.environ, {'SMS_KEY': 'sms-key'}),
+                        mock.patch('users.permissions.sms_history')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def push(self, text):
+        return self.client.post(reverse('orders:push-sms'), {'activationId': '1', 'text': text},
+                                content_type='application/json', HTTP_AUTHORIZATION='Key sms-key')
+
+    def test_repeat_delivery(self):
+        self.assertEqual(self.push('a').data['message'], MESSAGES[Order.NumberStatus.SUCCESS])
+        self.assertEqual(self.push('a').data['message'], MESSAGES['duplicate'])
+        recent_sms.clear()
+        self.assertEqual(self.push('a').data['message'], MESSAGES['duplicate'])
+        self.assertEqual(self.push('b').data['message'], MESSAGES[Order.NumberStatus.SUCCESS])
+        self.assertEqual(list(OrderSMS.objects.values_list('sms_code', flat=True).order_by('id')), ['a', 'b'])
+
+
+class SMSInboxTest(TestCase):
+    """Queued SMS are judged by when they arrived and bad ones do not block the inbox."""
+
+    def setUp(self):
+        activation_cache.clear()
+        recent_sms.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.order = Order.objects.create(user=self.user, country='us', service='tg', amount=100, activation_id='1',
+                                          created_at=timezone.now() - timedelta(minutes=30))
+        SMSInbox.objects.create(payload={'activationId': 1, 'text': 'a'},
+                                received_at=self.order.created_at + timedelta(minutes=5))
+
+    def test_sms_received_in_time_is_applied(self):
+        self.assertEqual(Order.expire_overdue(), 0)
+        self.assertEqual(drain_inbox(), 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, Order.NumberStatus.SUCCESS)
+        self.assertFalse(SMSInbox.objects.exists())
+        self.assertEqual(UserBalance.amount_of(self.user), 0)
+
+    def test_failing_sms_are_set_aside(self):
+        SMSInbox.objects.create(payload={'activationId': '1', 'text': 'x' * 256})
+        SMSInbox.objects.create(payload={'activationId': '1', 'text': 'boom'})
+
+        def apply(events, **kwargs):
+            if any(event['text'] == 'boom' for event in events):
+                raise DataError('value too long')
+            return apply_sms_batch(events, **kwargs)
+
+        with mock.patch('orders.sms.apply_sms_batch', side_effect=apply):
+            self.assertEqual(drain_inbox(), 3)
+        self.assertEqual(drain_inbox(), 0)
+        self.assertEqual(list(OrderSMS.objects.values_list('sms_code', flat=True)), ['a'])
+        failed = SMSInbox.objects.order_by('id')
+        self.assertEqual([message.payload['text'][:4] for message in failed], ['xxxx', 'boom'])
+        self.assertTrue(all(message.failed_at and message.last_error for message in failed))
+
+
+class SMSHistoryBufferTest(TransactionTestCase):
+    """Buffered history is written in batches by a background thread, or directly when the buffer is full."""
+
+    def buffer(self, **kwargs):
+        buffer = SMSHistoryBuffer(**kwargs)
+        self.addCleanup(buffer.close)
+        return buffer
+
+    def wait_for_records(self, count, timeout=2):
+        deadline = time.monotonic() + timeout
+        while SMSHistory.objects.count() < count and time.monotonic() < deadline:
+            time.sleep(0.02)
+        return SMSHistory.objects.count()
+
+    def test_flush_on_size(self):
+        buffer = self.buffer(flush_size=2, flush_interval=30)
+        buffer.add({'activationId': '1'})
+        time.sleep(0.1)
+        self.assertEqual(SMSHistory.objects.count(), 0)
+        buffer.add({'activationId': '2'})
+        self.assertEqual(self.wait_for_records(2), 2)
+
+    def test_flush_on_interval(self):
+        buffer = self.buffer(flush_size=200, flush_interval=0.1)
+        buffer.add({'activationId': '1'})
+        self.assertEqual(self.wait_for_records(1), 1)
+
+    def test_full_buffer_writes_directly(self):
+        buffer = self.buffer(max_size=1)
+        with mock.patch.object(buffer, '_ensure_started'):
+            buffer.add({'activationId': '1'})
+            buffer.add({'activationId': '2'})
+        self.assertEqual(list(SMSHistory.objects.values_list('request_data', flat=True)), [{'activationId': '2'}])
+        self.assertEqual(buffer.queue.qsize(), 1)
+
+    def test_flush_on_close(self):
+        buffer = self.buffer(flush_size=200, flush_interval=0.2)
+        for activation_id in range(3):
+            buffer.add({'activationId': str(activation_id)})
+        buffer.close()
+        self.assertEqual(SMSHistory.objects.count(), 3)
+
+    def test_failing_records_are_dropped(self):
+        buffer = self.buffer(flush_size=2, flush_interval=30, retry_delay=0.01, max_retries=2)
+        with self.assertLogs('orders.audit', 'ERROR') as logs:
+            buffer.add({'activationId': object()})
+            buffer.add({'activationId': '2'})
+            self.assertEqual(self.wait_for_records(1), 1)
+            buffer.close()
+        self.assertIn('Dropped 1 SMS history records', logs.output[-1])
+        buffer = self.buffer(flush_size=1, flush_interval=30)
+        buffer.add({'activationId': '3'})
+        self.assertEqual(self.wait_for_records(2), 2)
+
+
+class FailingBackend(DjangoMailBackend):
+    def send(self, email):
+        raise ConnectionError('unreachable')
+
+
+class EmailOutboxTest(TestCase):
+    """Queued emails are sent in batches and failed ones retried with backoff."""
+
+    def setUp(self):
+        send_emails('from@example.com', 'to@example.com', 'Subject', '<strong>Body</strong>')
+
+    def test_send(self):
+        self.assertEqual(send_outbox(DjangoMailBackend()), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['to@example.com'])
+        self.assertIsNotNone(EmailOutbox.objects.get().sent_at)
+        self.assertEqual(send_outbox(DjangoMailBackend()), (0, 0))
+
+    def test_retry_with_backoff(self):
+        self.assertEqual(send_outbox(FailingBackend(), backoff=30), (0, 1))
+        email = EmailOutbox.objects.get()
+        self.assertEqual((email.attempts, email.last_error), (1, 'ConnectionError: unreachable'))
+        self.assertGreater(email.next_attempt_at, timezone.now() + timedelta(seconds=25))
+        self.assertEqual(send_outbox(DjangoMailBackend()), (0, 0))
+
+    def test_give_up(self):
+        EmailOutbox.objects.update(attempts=1)
+        self.assertEqual(send_outbox(FailingBackend(), max_attempts=2), (0, 1))
+        self.assertIsNone(EmailOutbox.objects.get().next_attempt_at)
+
+    def test_worker_dying_midway(self):
+        send_emails('from@example.com', 'other@example.com', 'Subject', '<strong>Body</strong>')
+        backend = DjangoMailBackend()
+        with mock.patch.object(backend, 'send', side_effect=[None, KeyboardInterrupt]):
+            with self.assertRaises(KeyboardInterrupt):
+                send_outbox(backend, lease=60)
+        sent, leased = EmailOutbox.objects.order_by('id')
+        self.assertIsNotNone(sent.sent_at)
+        self.assertIsNone(leased.sent_at)
+        self.assertGreater(leased.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(send_outbox(DjangoMailBackend()), (0, 0))
+
+    def test_sendgrid_timeout(self):
+        self.assertEqual(SendGridBackend().client.client.timeout, 10)
+
+
+class BalanceLedgerTest(TestCase):
+    """Balances are ledger entries on top of a compacted snapshot."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        UserBalance.credit(self.user, 10.1, kind=BalanceEntry.Kind.DEPOSIT)
+
+    def test_debit(self):
+        self.assertEqual(UserBalance.debit(self.user, 0.3), 9.8)
+        self.assertIsNone(UserBalance.debit(self.user, 9.81))
+        self.assertEqual(list(BalanceEntry.objects.values_list('amount', flat=True).order_by('id')), [1010, -30])
+        self.assertEqual(UserBalance.objects.get(pk=self.user).amount, 0)
+
+    def test_compact_and_reconcile(self):
+        UserBalance.debit(self.user, 0.1)
+        self.assertEqual(UserBalance.compact(lag=timedelta(0)), 1)
+        self.assertEqual(UserBalance.objects.get(pk=self.user).amount, 1000)
+        UserBalance.credit(self.user, 1)
+        self.assertEqual(UserBalance.amount_of(self.user.pk), 11)
+        self.assertEqual(UserBalance.reconcile(), [])
+
+        UserBalance.objects.filter(pk=self.user).update(amount=0)
+        self.assertEqual(UserBalance.reconcile(), [(self.user.pk, 0, 1000)])
+
+    def test_compact_counts_late_commits(self):
+        # An entry created before others but committed after they were folded.
+        late = BalanceEntry(user=self.user, amount=500, kind=BalanceEntry.Kind.DEPOSIT,
+                            created_at=timezone.now() - timedelta(minutes=5))
+        UserBalance.debit(self.user, 0.1)
+        UserBalance.compact(lag=timedelta(0))
+        late.save()
+        self.assertEqual(UserBalance.amount_of(self.user), 15)
+        self.assertEqual(UserBalance.compact(lag=timedelta(0), batch_size=1), 1)
+        self.assertEqual(UserBalance.objects.get(pk=self.user).amount, 1500)
+        self.assertEqual(UserBalance.reconcile(), [])
+
+    def test_sharded_debit(self):
+        UserBalance.set_shards(self.user.pk, 3)
+        self.assertEqual(list(BalanceShard.objects.order_by('index').values_list('amount', flat=True)), [337, 337, 336])
+        self.assertEqual(UserBalance.debit(self.user, 3), 7.1)
+        self.assertEqual(sum(BalanceShard.objects.values_list('amount', flat=True)), 710)
+
+        # No shard holds 5, the debit rebalances the shards instead.
+        self.assertEqual(UserBalance.debit(self.user, 5), 2.1)
+        self.assertEqual(list(BalanceShard.objects.order_by('index').values_list('amount', flat=True)), [70, 70, 70])
+        self.assertIsNone(UserBalance.debit(self.user, 2.2))
+
+        UserBalance.credit(self.user, 3)
+        self.assertEqual(UserBalance.rebalance(), 1)
+        self.assertEqual(sum(BalanceShard.objects.values_list('amount', flat=True)), 510)
+        UserBalance.set_shards(self.user.pk, 0)
+        self.assertFalse(BalanceShard.objects.exists())
+        self.assertEqual(UserBalance.debit(self.user, 5.1), 0)
+
+
+class BulkOrderTest(TestCase):
+    """Bulk orders reserve the total once and refund the items that failed."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        _, self.key = UserAPIKey.objects.create_key(user=self.user, prefix=self.user.email, name='Key')
+        UserBalance.credit(self.user, 10, kind=BalanceEntry.Kind.DEPOSIT)
+
+    @staticmethod
+    def order_number(service, country):
+        if country == 'slow':
+            time.sleep(0.3)
+        if country == 'xx':
+            raise ProviderError('timeout')
+        if country == 'yy':
+            return mock.Mock(status_code=400)
+        return mock.Mock(status_code=200, json=lambda: {'activationId': f'{service}-{country}', 'number': '123'})
+
+    def place(self, items):
+        with mock.patch('orders.views.provider.order_number', side_effect=self.order_number):
+            return self.client.post(reverse('orders:place-user-orders-bulk'), items, content_type='application/json',
+                                    HTTP_AUTHORIZATION=f'Bearer {self.key}')
+
+    def test_bulk_order(self):
+        response = self.place([
+            {'service': 'TG', 'country': 'us', 'amount': 1.5},
+            {'service': 'tg', 'country': 'xx', 'amount': 2},
+            {'service': 'tg', 'country': 'yy', 'amount': 3},
+            {'service': 'wa', 'country': 'us', 'amount': 0.5},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'amount': 8, 'results': [
+            {'status': 200, 'number': '123', 'activationID': 'tg-us'},
+            {'status': 502, 'message': 'Number provider did not respond in time. Please try again.'},
+            {'status': 400, 'message': 'Error in acquiring number. '
+                                       'This might be because the service or country is not correct.'},
+            {'status': 200, 'number': '123', 'activationID': 'wa-us'},
+        ]})
+        self.assertEqual(list(Order.objects.values_list('activation_id', 'status').order_by('id')),
+                         [('tg-us', Order.NumberStatus.SMS_PENDING), ('wa-us', Order.NumberStatus.SMS_PENDING)])
+        self.assertEqual(list(Order.objects.values_list('amount', flat=True).order_by('id')), [150, 50])
+        self.assertEqual(list(BalanceEntry.objects.values_list('amount', flat=True).order_by('id')), [1000, -700, 500])
+
+    @mock.patch.object(CreateBulkOrderView, 'deadline', 0.1)
+    def test_calls_not_started_by_deadline_are_refunded(self):
+        with mock.patch('orders.views.bulk_order_pool', ThreadPoolExecutor(max_workers=1)):
+            response = self.place([{'service': 'tg', 'country': 'slow', 'amount': 1}] * 3)
+        self.assertEqual([result['status'] for result in response.json()['results']], [200, 504, 504])
+        self.assertEqual(response.json()['amount'], 9)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_abandoned_placements_are_refunded(self):
+        Order.objects.create(user=self.user, country='us', service='tg', amount=200, status=Order.NumberStatus.PLACING,
+                             created_at=timezone.now() - timedelta(minutes=30))
+        UserBalance.debit(self.user, 2)
+        self.assertEqual(Order.expire_overdue(), 1)
+        self.assertEqual(UserBalance.amount_of(self.user), 10)
+
+    def test_cancel_while_placing(self):
+        order = Order.objects.create(user=self.user, country='us', service='tg', amount=200,
+                                     status=Order.NumberStatus.PLACING)
+        token = Token.objects.create(user=self.user)
+        response = self.client.get(reverse('orders:cancel-order', args=[order.pk]),
+                                   HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, 409)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.NumberStatus.PLACING)
+        self.assertEqual(UserBalance.amount_of(self.user), 10)
+
+    def test_insufficient_funds(self):
+        response = self.place([{'service': 'tg', 'country': 'us', 'amount': 6}] * 2)
+        self.assertEqual(response.status_code, 406)
+        self.assertFalse(Order.objects.exists())
+
+
+class CreateOrderRefundTest(TestCase):
+    """The reserved amount is given back whenever no order is saved after the provider call."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.token = Token.objects.create(user=self.user)
+        UserBalance.credit(self.user, 10, kind=BalanceEntry.Kind.DEPOSIT)
+
+    def place(self, body):
+        response = mock.Mock(status_code=200, text=json.dumps(body), json=lambda: body)
+        with mock.patch('orders.views.provider.order_number', return_value=response):
+            return self.client.post(reverse('orders:place-app-order'), {'service': 'tg', 'country': 'us', 'amount': 2},
+                                    content_type='application/json', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_invalid_provider_response(self):
+        with self.assertLogs('orders.views', 'ERROR'):
+            response = self.place({'number': '123'})
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(UserBalance.amount_of(self.user), 10)
+        self.assertFalse(Order.objects.exists())
+
+    def test_order_not_saved(self):
+        self.assertEqual(self.place({'activationId': '1', 'number': '123'}).status_code, 200)
+        with self.assertRaises(IntegrityError):
+            self.place({'activationId': '1', 'number': '456'})
+        self.assertEqual(UserBalance.amount_of(self.user), 8)
+        self.assertEqual(Order.objects.count(), 1)
+
+
+class IdempotencyKeyTest(TestCase):
+    """Retries with the same Idempotency-Key get the first reply without ordering again."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.token = Token.objects.create(user=self.user)
+        UserBalance.credit(self.user, 10, kind=BalanceEntry.Kind.DEPOSIT)
+        self.order_number = mock.Mock(return_value=mock.Mock(
+            status_code=200, json=lambda: {'activationId': '1', 'number': '123'}
+        ))
+        patcher = mock.patch('orders.views.provider.order_number', self.order_number)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def place(self, key, amount=2):
+        return self.client.post(reverse('orders:place-app-order'), {'service': 'tg', 'country': 'us', 'amount': amount},
+                                content_type='application/json', HTTP_AUTHORIZATION=f'Token {self.token.key}',
+                                HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_retry_replays_reply(self):
+        first, retry = self.place('key'), self.place('key')
+        self.assertEqual(first.json(), {'amount': 8, 'number': '123', 'activationID': '1'})
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.order_number.call_count, 1)
+        self.assertEqual(UserBalance.amount_of(self.user), 8)
+        self.assertEqual(self.place('key', amount=3).status_code, 422)
+
+    def test_in_progress_and_failed_requests(self):
+        key = idempotency.reply_key(self.user.pk, 'key')
+        idempotency.claim(key, idempotency.fingerprint({'service': 'tg', 'country': 'us', 'amount': 2}))
+        with mock.patch.object(idempotency, 'WAIT_TIMEOUT', 0):
+            self.assertEqual(self.place('key').status_code, 409)
+        self.order_number.assert_not_called()
+
+        cache.clear()
+        self.order_number.side_effect = ProviderError('timeout')
+        self.assertEqual(self.place('key').status_code, 502)
+        self.order_number.side_effect = None
+        self.assertEqual(self.place('key').status_code, 200)
+        self.assertEqual(self.order_number.call_count, 2)
+
+    def test_refused_requests_not_replayed(self):
+        self.assertEqual(self.place('key', amount=20).status_code, 406)
+        UserBalance.credit(self.user, 10, kind=BalanceEntry.Kind.DEPOSIT)
+        self.assertEqual(self.place('key', amount=20).status_code, 200)
+        self.assertEqual(self.place('other', amount='two').status_code, 400)
+        self.assertEqual(self.order_number.call_count, 1)
+        self.assertEqual(UserBalance.amount_of(self.user), 0)
+
+
+class StubProviderHandler(StubHandler):
+    """Answer orders like the number provider, slowly or failing for some countries."""
+
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.requests.append(body)
+        if body['country'] == 'slow':
+            time.sleep(0.5)
+        status = 500 if body['country'] == 'down' else 200
+        self.reply(status, {'activationId': str(len(self.requests)), 'number': '123'})
+
+
+class ProviderClientTest(StubServerMixin, TestCase):
+    """Provider calls are bounded by timeouts and short-circuited while the provider is down."""
+
+    stub_handler = StubProviderHandler
+
+    def setUp(self):
+        StubProviderHandler.requests = []
+        self.provider = ProviderClient(url=self.url, read_timeout=0.2, backoff_factor=0.01,
+                                     breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+
+    def test_order_number(self):
+        response = self.provider.order_number('tg', 'us')
+        self.assertEqual((response.status_code, response.json()['number']), (200, '123'))
+        self.assertEqual(StubProviderHandler.requests, [{'service': 'tg', 'country': 'us'}])
+
+    def test_read_timeout_is_not_retried(self):
+        with self.assertRaises(ProviderError):
+            self.provider.order_number('tg', 'slow')
+        self.assertEqual(len(StubProviderHandler.requests), 1)
+
+    def test_connection_failure_is_retried(self):
+        client = ProviderClient(url='http://127.0.0.1:1/', retries=2, backoff_factor=0.01)
+        with mock.patch('urllib3.util.retry.Retry.increment', autospec=True,
+                        side_effect=Retry.increment) as increment, self.assertRaises(ProviderError):
+            client.order_number('tg', 'us')
+        self.assertEqual(increment.call_count, 3)
+
+    def test_breaker_opens_and_recovers(self):
+        for _ in range(2):
+            self.assertEqual(self.provider.order_number('tg', 'down').status_code, 500)
+        with self.assertRaises(ProviderUnavailable):
+            self.provider.order_number('tg', 'us')
+        self.assertEqual(len(StubProviderHandler.requests), 2)
+
+        time.sleep(0.2)
+        self.assertEqual(self.provider.order_number('tg', 'us').status_code, 200)
+        self.assertFalse(self.provider.breaker.is_open)
+
+
+class AsyncCreateOrderTest(StubServerMixin, TestCase):
+    """Async order views call the provider with httpx, throttle before authenticating and refund failures."""
+
+    stub_handler = StubProviderHandler
+
+    def setUp(self):
+        StubProviderHandler.requests = []
+        self.user = get_user_model().objects.create_user('user@example.com', 'password')
+        self.token = Token.objects.create(user=self.user)
+        _, self.key = UserAPIKey.objects.create_key(user=self.user, prefix=self.user.email, name='Key')
+        UserBalance.credit(self.user, 10, kind=BalanceEntry.Kind.DEPOSIT)
+        for patcher in [mock.patch('orders.async_views.provider', ProviderClient(url=self.url, read_timeout=1)),
+                        mock.patch('users.throttling.store', MemoryBucketStore())]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def place(self, country='us', url_name='orders:place-app-order-async', authorization=None):
+        # The async client takes headers by their HTTP name.
+        return await self.async_client.post(reverse(url_name), {'service': 'tg', 'country': country, 'amount': 2},
+                                            content_type='application/json',
+                                            authorization=authorization or f'Token {self.token.key}')
+
+    async def test_app_order(self):
+        response = await self.place()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'amount': 8, 'number': '123', 'activationID': '1'})
+        self.assertEqual(StubProviderHandler.requests, [{'service': 'tg', 'country': 'us'}])
+        order = await Order.objects.aget(user=self.user)
+        self.assertEqual((order.activation_id, order.amount), ('1', 200))
+
+    async def test_user_order(self):
+        response = await self.place(url_name='orders:place-user-order-async', authorization=f'Bearer {self.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['amount'], 8)
+
+    async def test_unauthenticated(self):
+        response = await self.place(authorization='Token invalid')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(StubProviderHandler.requests, [])
+
+    @mock.patch.object(UserOrderThrottle, 'rate', '1/min')
+    async def test_throttled_before_key_check(self):
+        await self.place(url_name='orders:place-user-order-async', authorization='Bearer prefix.secret')
+        with mock.patch('users.permissions.UserHasAPIKey.get_user_id') as get_user_id:
+            response = await self.place(url_name='orders:place-user-order-async',
+                                        authorization='Bearer prefix.other')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        get_user_id.assert_not_called()
+
+    async def test_failed_orders_are_refunded(self):
+        with self.assertLogs('orders.views', 'WARNING'):
+            response = await self.place(country='down')
+        self.assertEqual(response.status_code, 500)
+        with mock.patch('orders.async_views.provider', ProviderClient(url='http://127.0.0.1:1', retries=0)):
+            response = await self.place()
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(await sync_to_async(UserBalance.amount_of)(self.user.pk), 10)
+        self.assertFalse(await Order.objects.aexists())
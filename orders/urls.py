@@ -1,14 +1,17 @@
 """URLs for User."""
 
 from django.urls import path
+from orders.async_views import AsyncCreateAppOrderView, AsyncCreateUserOrderView
 from orders.views import (
     BalanceAddView,
     BalanceHistoryView,
     CancelOrderView,
     CreateAppOrderView,
+    CreateBulkOrderView,
     CreateUserOrderView,
     ListOrderView,
     UpdateSMSView,
+    BatchUpdateSMSView,
     FinishOrderView,
     ListActiveOrdersView
 )
@@ -18,6 +21,9 @@ app_name = 'orders'
 urlpatterns = [
     path('app_place', CreateAppOrderView.as_view(), name='place-app-order'),
     path('user_place', CreateUserOrderView.as_view(), name='place-user-order'),
+    path('user_place_bulk', CreateBulkOrderView.as_view(), name='place-user-orders-bulk'),
+    path('app_place_async', AsyncCreateAppOrderView.as_view(), name='place-app-order-async'),
+    path('user_place_async', AsyncCreateUserOrderView.as_view(), name='place-user-order-async'),
     path('list', ListOrderView.as_view(), name='list-orders'),
     path('list_active', ListActiveOrdersView.as_view(), name='list-active-orders'),
     path('add_balance', BalanceAddView.as_view(), name='add-balance'),
@@ -25,4 +31,5 @@ urlpatterns = [
     path('cancel/<int:order_id>', CancelOrderView.as_view(), name='cancel-order'),
     path('finish/<int:order_id>', FinishOrderView.as_view(), name='finish-order'),
     path('push_sms', UpdateSMSView.as_view(), name='push-sms'),
+    path('push_sms_batch', BatchUpdateSMSView.as_view(), name='push-sms-batch'),
 ]
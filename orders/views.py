@@ -1,12 +1,24 @@
 """Views for orders."""
 
+import logging
 from abc import ABC, abstractmethod
-import requests
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import environ
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.shortcuts import get_object_or_404
-from rest_framework.status import HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_406_NOT_ACCEPTABLE, HTTP_400_BAD_REQUEST
+from rest_framework.status import (
+    HTTP_200_OK,
+    HTTP_202_ACCEPTED,
+    HTTP_404_NOT_FOUND,
+    HTTP_406_NOT_ACCEPTABLE,
+    HTTP_400_BAD_REQUEST,
+    HTTP_409_CONFLICT,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+    HTTP_502_BAD_GATEWAY,
+    HTTP_503_SERVICE_UNAVAILABLE,
+    HTTP_504_GATEWAY_TIMEOUT
+)
 from rest_framework.views import APIView
 from rest_framework.generics import UpdateAPIView, ListAPIView
 from rest_framework.response import Response
@@ -17,134 +29,327 @@ from orders.serializers import (
     CreateOrderSerializer,
     ListOrderSerializer
 )
-from orders.models import UserBalance, UserBalanceHistory, Order, OrderSMS
-from users.permissions import IsLoggedIn, IsUserAPI, SMSSenderKeyAuthentication
-from users.models import UserAPIKey
+from orders import idempotency
+from orders.models import (
+    BalanceEntry,
+    UserBalance,
+    UserBalanceHistory,
+    Order,
+    OrderSMS,
+    SMSHistory,
+    SMSInbox,
+    to_major,
+    to_minor
+)
+from orders.pagination import KeysetPagination
+from orders.provider import provider, ProviderError, ProviderUnavailable
+from orders.sms import MESSAGES, apply_sms_batch, event_error, remember, seen_recently, sms_digest
+from users.permissions import IsLoggedIn, IsUserAPI, SMSSenderKeyAuthentication, SMSSenderBatchKeyAuthentication
+from users.models import User
+from users.throttling import AppOrderThrottle, BulkOrderThrottle, ThrottleBeforePermissions, UserOrderThrottle
 
 env = environ.Env()
 environ.Env.read_env()
 
+logger = logging.getLogger(__name__)
 
-class CreateOrderView(APIView, ABC):
-    """Create order for user."""
+# Provider calls of bulk orders in this process, bounded to the provider's connection pool.
+bulk_order_pool = ThreadPoolExecutor(max_workers=env.int('BULK_ORDER_WORKERS', default=provider.pool_size))
 
-    user = None
+PROVIDER_MESSAGES = {
+    HTTP_502_BAD_GATEWAY: 'Number provider did not respond in time. Please try again.',
+    HTTP_503_SERVICE_UNAVAILABLE: 'Number provider is temporarily unavailable. Please try again later.',
+    'rejected': 'Error in acquiring number. This might be because the service or country is not correct.',
+    HTTP_504_GATEWAY_TIMEOUT: 'Number was not ordered before the request deadline. Please try again.',
+    'invalid': 'Number provider sent an invalid response. Please try again.',
+}
+
+
+def provider_number(response):
+    """Activation id and number from a successful provider response, None if its body is not as expected."""
+    try:
+        data = response.json()
+        return data['activationId'], data['number']
+    except (ValueError, KeyError, TypeError):
+        logger.error('Provider sent an invalid order response: %s', response.text[:500])
+        return None
 
-    @abstractmethod
-    def set_user(self):
-        """Set user after authentication."""
-        pass
 
-    def create_data(self, request):
+def order_data(request_data, user):
+    """Order serializer data from request data of an order."""
+    def extract_data(key):
+        return request_data[key].lower() if key in request_data.keys() else None
+
+    return {
+        'country': extract_data('country'),
+        'service': extract_data('service'),
+        'user': user.id,
+        'amount': request_data.get('amount')
+    }
+
+
+class OrderPlacement:
+    """Steps of placing an order, shared by sync and async views.
+
+    Steps return a status code and response data so each view can wrap them in
+    the response class of its own stack.
+    """
+
+    user = None
+    remaining_balance = None
+
+    def create_data(self, request_data):
         """Create order from request."""
-        def extract_data(key):
-            return request.data[key].lower() if key in request.data.keys() else None
-
-        data = {
-            'country': extract_data('country'),
-            'service': extract_data('service'),
-            'user': self.user.id,
-            'amount': request.data.get('amount')
-        }
-        return CreateOrderSerializer(data=data)
+        return CreateOrderSerializer(data=order_data(request_data, self.user))
+
+    def prepare_order(self, request_data):
+        """Validate order data and reserve its amount, return serializer and error if any."""
+        order_serializer = self.create_data(request_data)
+
+        if not order_serializer.is_valid():
+            return order_serializer, (HTTP_400_BAD_REQUEST, order_serializer.errors)
+        self.remaining_balance = UserBalance.debit(self.user, to_major(order_serializer.validated_data['amount']))
+        if self.remaining_balance is None:
+            return order_serializer, (HTTP_406_NOT_ACCEPTABLE, {'message': 'Insufficient funds'})
+        return order_serializer, None
+
+    def release_order(self, order_serializer):
+        """Give the reserved amount back if a number could not be acquired."""
+        self.remaining_balance = UserBalance.credit(self.user, to_major(order_serializer.validated_data['amount']))
+
+    def provider_error(self, error, order_serializer):
+        """Release reserved amount for a provider call that did not go through."""
+        self.release_order(order_serializer)
+        status = HTTP_503_SERVICE_UNAVAILABLE if isinstance(error, ProviderUnavailable) else HTTP_502_BAD_GATEWAY
+        return status, {'message': PROVIDER_MESSAGES[status]}
 
     def create_order(self, response, order_serializer):
-        """Create order entry after successful API call."""
-        response_data = response.json()
-        with transaction.atomic():
-            order = order_serializer.save()
-            order.activation_id = response_data['activationId']
-            order.number = response_data['number']
-            order.save()
-
-        remaining_balance = UserBalance.update_balance(self.user, order_serializer.validated_data['amount'] * -1)
-        return Response(status=HTTP_200_OK, data={
-            'amount': remaining_balance,
+        """Create order entry after successful API call, releasing the reserved amount if it cannot be saved."""
+        if response.status_code != 200:
+            logger.warning('Provider rejected %s order in %s with %s: %s',
+                           order_serializer.validated_data['service'], order_serializer.validated_data['country'],
+                           response.status_code, response.text[:500])
+            self.release_order(order_serializer)
+            return response.status_code, {'message': PROVIDER_MESSAGES['rejected']}
+
+        ordered = provider_number(response)
+        if ordered is None:
+            self.release_order(order_serializer)
+            return HTTP_502_BAD_GATEWAY, {'message': PROVIDER_MESSAGES['invalid']}
+        try:
+            with transaction.atomic():
+                order = order_serializer.save(activation_id=ordered[0], number=ordered[1])
+        except Exception:
+            self.release_order(order_serializer)
+            raise
+        order.cache_state()
+        return HTTP_200_OK, {
+            'amount': self.remaining_balance,
             'number': order.number,
             'activationID': order.activation_id
-        })
+        }
+
+
+class CreateOrderView(OrderPlacement, APIView, ABC):
+    """Create order for user."""
+
+    @abstractmethod
+    def set_user(self):
+        """Set user after authentication."""
+        pass
 
     def order_number(self, order_serializer):
         """Call the order API to get number and details."""
-        response = requests.post(
-            env('ORDER_API'),
-            json={
-                'service': order_serializer.validated_data['service'],
-                'country': order_serializer.validated_data['country']
-            }
-        )
-
-        if response.status_code == 200:
-            return self.create_order(response, order_serializer)
-        print(response.text)
-        return Response(status=response.status_code, data={
-            'message': 'Error in acquiring number. This might be because the service or country is not correct.'
-        })
+        try:
+            response = provider.order_number(
+                order_serializer.validated_data['service'],
+                order_serializer.validated_data['country']
+            )
+        except ProviderError as e:
+            return self.provider_error(e, order_serializer)
+        except Exception:
+            self.release_order(order_serializer)
+            raise
+        return self.create_order(response, order_serializer)
+
+    def place_order(self, request_data):
+        """Validate, reserve and order a number, return status code and response data."""
+        order_serializer, error = self.prepare_order(request_data)
+
+        if error:
+            return error
+        return self.order_number(order_serializer)
 
     def post(self, request):
-        """Order a number for user."""
+        """Order a number for user.
+
+        A retry with the Idempotency-Key header of an earlier request gets the
+        reply of that request instead of ordering again.
+        """
         self.set_user()
-        order_serializer = self.create_data(request)
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key is None:
+            status, data = self.place_order(request.data)
+            return Response(status=status, data=data)
+        if not idempotency_key or len(idempotency_key) > idempotency.MAX_KEY_LENGTH:
+            return Response(status=HTTP_400_BAD_REQUEST, data={
+                'message': f'Idempotency-Key must be 1 to {idempotency.MAX_KEY_LENGTH} characters'
+            })
+
+        key = idempotency.reply_key(self.user.pk, idempotency_key)
+        digest = idempotency.fingerprint(request.data)
+        claimed, stored = idempotency.claim(key, digest)
+        if not claimed:
+            if stored is None:
+                return Response(status=HTTP_409_CONFLICT,
+                                data={'message': 'A request with this Idempotency-Key is still in progress'})
+            if stored[0] != digest:
+                return Response(status=HTTP_422_UNPROCESSABLE_ENTITY,
+                                data={'message': 'Idempotency-Key was already used for a different request'})
+            status, data = stored[1]
+            return Response(status=status, data=data, headers={'Idempotent-Replayed': 'true'})
 
-        if not order_serializer.is_valid():
-            return Response(status=HTTP_400_BAD_REQUEST, data=order_serializer.errors)
-        if not UserBalance.has_balance(self.user, order_serializer.validated_data['amount']):
-            return Response(status=HTTP_406_NOT_ACCEPTABLE, data={'message': 'Insufficient funds'})
-        return self.order_number(order_serializer)
+        try:
+            order_serializer, error = self.prepare_order(request.data)
+            if error:
+                # Nothing was debited or ordered, so a corrected retry or top-up may go through.
+                idempotency.release(key)
+                return Response(status=error[0], data=error[1])
+            status, data = self.order_number(order_serializer)
+        except Exception:
+            idempotency.release(key)
+            raise
+        if status >= 500:
+            # The reserved amount was released for server errors, so a retry may order again.
+            idempotency.release(key)
+        else:
+            idempotency.store(key, digest, status, data)
+        return Response(status=status, data=data)
 
 
 class CreateAppOrderView(IsLoggedIn, CreateOrderView):
     """Handle order creation requests from frontend app."""
     """There is no need to pass Token to complete this project. """
+    throttle_classes = [AppOrderThrottle, ]
+
     def set_user(self):
         """Set user for this instance."""
         self.user = self.request.user
 
 
-class CreateUserOrderView(IsUserAPI, CreateOrderView):
+class CreateUserOrderView(ThrottleBeforePermissions, IsUserAPI, CreateOrderView):
     """Handle order creation requests from API key."""
 
+    throttle_classes = [UserOrderThrottle, ]
+
     def set_user(self):
-        """Set user for this instance."""
-        key = self.request.META["HTTP_AUTHORIZATION"].split()[1]
-        user_key = UserAPIKey.objects.get_from_key(key)
-        self.user = user_key.user
+        """Set user for this instance, the key was resolved by the permission check."""
+        self.user = User.objects.get(pk=self.request.api_key_user_id)
 
 
-class ListOrderView(IsLoggedIn, ListAPIView):
-    """List orders."""
+class CreateBulkOrderView(ThrottleBeforePermissions, IsUserAPI, APIView):
+    """Order several numbers for user from API key in one request.
 
-    serializer_class = ListOrderSerializer
+    The total amount is debited and an order in `placing` status is saved per
+    item in one transaction, then the provider calls run concurrently in
+    `bulk_order_pool`. Calls not started within `deadline` seconds are not
+    made, so the request ends within the deadline plus one provider call.
+    Placed orders are then updated with their numbers, the rest deleted and
+    their amount refunded with one credit. Orders left in `placing` by a
+    request that was killed are refunded by `expire_orders`.
+    """
 
-    def get_queryset(self):
-        """Get list of user's orders."""
-        return Order.objects.filter(user=self.request.user)
+    throttle_classes = [BulkOrderThrottle, ]
+    max_items = env.int('BULK_ORDER_MAX_ITEMS', default=100)
+    deadline = env.float('BULK_ORDER_DEADLINE', default=10)
 
-    def filter_queryset(self, queryset):
-        """Expire orders if required."""
-        for order in queryset:
-            if order.has_expired():
-                order.cancel()
-        return queryset
+    @staticmethod
+    def order_number(item):
+        """Call the order API for a validated item, return status and provider data or message."""
+        try:
+            response = provider.order_number(item['service'], item['country'])
+        except ProviderError as e:
+            status = HTTP_503_SERVICE_UNAVAILABLE if isinstance(e, ProviderUnavailable) else HTTP_502_BAD_GATEWAY
+            return status, PROVIDER_MESSAGES[status]
+        if response.status_code != 200:
+            return response.status_code, PROVIDER_MESSAGES['rejected']
+        ordered = provider_number(response)
+        if ordered is None:
+            return HTTP_502_BAD_GATEWAY, PROVIDER_MESSAGES['invalid']
+        return HTTP_200_OK, ordered
+
+    def place_orders(self, items):
+        """Order numbers for items until the deadline, return status and provider data or message per item."""
+        calls = [bulk_order_pool.submit(self.order_number, item) for item in items]
+        wait(calls, timeout=self.deadline)
+        # Calls still queued are cancelled before waiting for the ones in flight.
+        cancelled = [call.cancel() for call in calls]
+        return [
+            (HTTP_504_GATEWAY_TIMEOUT, PROVIDER_MESSAGES[HTTP_504_GATEWAY_TIMEOUT]) if was_cancelled else call.result()
+            for call, was_cancelled in zip(calls, cancelled)
+        ]
 
-    def list(self, request, *args, **kwargs):
-        """List orders."""
-        queryset = self.filter_queryset(self.get_queryset())
+    def post(self, request):
+        """Order a list of service, country and amount items, return result for each of them."""
+        if not isinstance(request.data, list) or not request.data or \
+                not all(isinstance(item, dict) for item in request.data):
+            return Response(status=HTTP_400_BAD_REQUEST, data={'message': 'Expected a list of orders'})
+        if len(request.data) > self.max_items:
+            return Response(status=HTTP_400_BAD_REQUEST,
+                            data={'message': f'At most {self.max_items} orders are allowed per request'})
+
+        user = User.objects.get(pk=request.api_key_user_id)
+        serializer = CreateOrderSerializer(data=[order_data(item, user) for item in request.data], many=True)
+        if not serializer.is_valid():
+            return Response(status=HTTP_400_BAD_REQUEST, data={'errors': serializer.errors})
+        items = serializer.validated_data
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        with transaction.atomic():
+            remaining_balance = UserBalance.debit(user, to_major(sum(item['amount'] for item in items)))
+            if remaining_balance is None:
+                return Response(status=HTTP_406_NOT_ACCEPTABLE, data={'message': 'Insufficient funds'})
+            orders = Order.objects.bulk_create([Order(**item, status=Order.NumberStatus.PLACING) for item in items])
+
+        placed = self.place_orders(items)
+
+        results, failed = [], []
+        for order, (status, data) in zip(orders, placed):
+            if status == HTTP_200_OK:
+                order.activation_id, order.number = data
+                order.status = Order.NumberStatus.SMS_PENDING
+                results.append({'status': status, 'number': order.number, 'activationID': order.activation_id})
+            else:
+                failed.append(order)
+                results.append({'status': status, 'message': data})
+        with transaction.atomic():
+            Order.objects.bulk_update([order for order in orders if order not in failed],
+                                      ['activation_id', 'number', 'status'])
+            if failed:
+                Order.objects.filter(pk__in=[order.pk for order in failed]).delete()
+                remaining_balance = UserBalance.credit(user, to_major(sum(order.amount for order in failed)))
+        for order in orders:
+            if order not in failed:
+                order.cache_state()
+        return Response(status=HTTP_200_OK, data={'amount': remaining_balance, 'results': results})
 
-        serializer = self.get_serializer(queryset, many=True)
-        data = []
-        for x in serializer.data:
-            print(x,dict(x))
-            data.append(dict(x))
-        print(data)
-        data.sort(key=lambda x:x['created_at'])
 
-        return Response({'balance': request.user.balance.amount, 'orders': data[::-1]})
+class ListOrderView(IsLoggedIn, ListAPIView):
+    """List orders."""
+
+    serializer_class = ListOrderSerializer
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        """Get list of user's orders."""
+        return Order.objects.filter(user=self.request.user).prefetch_related('sms_codes')
+
+    def get_paginated_response(self, data):
+        """Return page of orders newest first along with user's balance."""
+        return Response({
+            'balance': UserBalance.amount_of(self.request.user),
+            'orders': data,
+            'next': self.paginator.get_next_link()
+        })
 
 
 class ListActiveOrdersView(ListOrderView):
@@ -153,15 +358,23 @@ class ListActiveOrdersView(ListOrderView):
     def get_queryset(self):
         """Get orders with sms_pending and success status."""
         filter_statuses = [Order.NumberStatus.SMS_PENDING, Order.NumberStatus.SUCCESS]
-        return Order.objects.filter(user=self.request.user, status__in=filter_statuses)
+        return Order.objects.filter(user=self.request.user, status__in=filter_statuses).prefetch_related('sms_codes')
 
 
 class CancelOrderView(IsLoggedIn, APIView):
     """Cancel order for user."""
 
+    not_cancellable = {
+        Order.NumberStatus.SUCCESS: 'Order is already successful',
+        Order.NumberStatus.FINISHED: 'Order is already finished',
+    }
+
     def update_data(self, order):
         """Update order status and balance."""
         remaining_amount, status = order.cancel()
+        if status in self.not_cancellable:
+            # SMS arrived between loading and cancelling the order.
+            return Response(status=HTTP_406_NOT_ACCEPTABLE, data={'message': self.not_cancellable[status]})
         return Response(status=HTTP_200_OK, data={'balance': remaining_amount, 'status': status})
 
     def get(self, request, order_id):
@@ -171,17 +384,15 @@ class CancelOrderView(IsLoggedIn, APIView):
         except Order.DoesNotExist:
             return Response(status=HTTP_404_NOT_FOUND, data={'message': 'Order Not Found'})
 
-        if order.status == Order.NumberStatus.SUCCESS:
-            return Response(
-                status=HTTP_406_NOT_ACCEPTABLE,
-                data={'message': 'Order is already successful'}
-            )
-
-        if order.status == Order.NumberStatus.FINISHED:
+        if order.status in self.not_cancellable:
             return Response(
                 status=HTTP_406_NOT_ACCEPTABLE,
-                data={'message': 'Order is already finished'}
+                data={'message': self.not_cancellable[order.status]}
             )
+        if order.status == Order.NumberStatus.PLACING:
+            # A bulk order is still waiting for the number, cancelling now would not stop it.
+            return Response(status=HTTP_409_CONFLICT,
+                            data={'message': 'Order is still being placed. Please try again in a moment.'})
 
         return self.update_data(order)
 
@@ -224,17 +435,31 @@ class FinishOrderView(IsLoggedIn, APIView):
 
 
 class UpdateSMSView(APIView):
-    """Update SMS from third party service."""
+    """Update SMS from third party service.
+
+    With SMS_INGEST_MODE set to queue the SMS is only stored in the inbox and
+    acknowledged, the process_sms_inbox worker applies it to the order.
+    """
 
     authentication_classes = [SMSSenderKeyAuthentication, ]
+    ingest_mode = env('SMS_INGEST_MODE', default='sync')
 
     def post(self, request):
         """Update SMS code and status against order."""
         if 'activationId' not in request.data.keys() or 'text' not in request.data.keys():
             return Response(status=HTTP_400_BAD_REQUEST, data={'activationId': 'Missing parameters'})
+        if event_error({'activationId': request.data['activationId'], 'text': request.data['text']}):
+            return Response(status=HTTP_400_BAD_REQUEST, data={'message': MESSAGES['invalid']})
+        if self.ingest_mode == 'queue':
+            SMSInbox.objects.create(payload={'activationId': request.data['activationId'], 'text': request.data['text']})
+            return Response(status=HTTP_202_ACCEPTED, data={'message': 'SMS queued'})
+
+        digest = sms_digest(request.data['activationId'], request.data['text'])
+        if seen_recently(digest):
+            return Response(status=HTTP_200_OK, data={'message': MESSAGES['duplicate']})
 
         try:
-            order = Order.objects.get(activation_id=request.data.get('activationId', ''))
+            order = Order.get_by_activation_id(request.data.get('activationId', ''))
         except Order.DoesNotExist:
             return Response(status=HTTP_404_NOT_FOUND, data={'message': 'Order not found against activation ID'})
 
@@ -246,12 +471,45 @@ class UpdateSMSView(APIView):
             order.cancel()
             return Response(status=HTTP_200_OK, data={'message': '20 minutes have already passed after order creation'})
 
-        order.status = Order.NumberStatus.SUCCESS
-        order.save()
-        OrderSMS.objects.create(order=order, sms_code=request.data.get('text', ''))
+        try:
+            with transaction.atomic():
+                # Inserted first so a repeat delivery fails on the digest before touching the order.
+                OrderSMS.objects.create(order=order, sms_code=request.data.get('text', ''), digest=digest)
+                if not order.transition([Order.NumberStatus.SMS_PENDING, Order.NumberStatus.SUCCESS],
+                                        Order.NumberStatus.SUCCESS):
+                    transaction.set_rollback(True)
+                    return Response(status=HTTP_200_OK, data={'message': 'Order is no longer active'})
+        except IntegrityError:
+            remember([digest])
+            return Response(status=HTTP_200_OK, data={'message': MESSAGES['duplicate']})
+
+        remember([digest])
         return Response(status=HTTP_200_OK, data={'message': 'SMS code added to order'})
 
 
+class BatchUpdateSMSView(APIView):
+    """Update SMS codes for many orders from third party service in one request."""
+
+    authentication_classes = [SMSSenderBatchKeyAuthentication, ]
+    ingest_mode = UpdateSMSView.ingest_mode
+    max_batch_size = 1000
+
+    def post(self, request):
+        """Apply a list of activationId and text pairs, return result for each of them."""
+        if not isinstance(request.data, list) or not request.data:
+            return Response(status=HTTP_400_BAD_REQUEST, data={'message': 'Expected a list of SMS events'})
+        if len(request.data) > self.max_batch_size:
+            return Response(status=HTTP_400_BAD_REQUEST,
+                            data={'message': f'At most {self.max_batch_size} SMS events are allowed per request'})
+
+        if self.ingest_mode == 'queue':
+            SMSHistory.objects.bulk_create([SMSHistory(request_data=event) for event in request.data])
+            SMSInbox.objects.bulk_create([SMSInbox(payload=event) for event in request.data])
+            return Response(status=HTTP_202_ACCEPTED, data={'message': f'{len(request.data)} SMS queued'})
+
+        return Response(status=HTTP_200_OK, data={'results': apply_sms_batch(request.data, record_history=True)})
+
+
 class BalanceAddView(IsLoggedIn, UpdateAPIView):
     """Add balance for a user."""
 
@@ -264,15 +522,14 @@ class BalanceAddView(IsLoggedIn, UpdateAPIView):
 
     def patch(self, request, *args, **kwargs):
         """Add amount in user balance."""
-        instance = self.get_object()
-        serializer = self.get_serializer(instance, data=request.data, partial=True)
+        serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
 
         if not serializer.validated_data['amount'] > 0:
             return Response(status=HTTP_400_BAD_REQUEST, data={'message': 'Amount should be greater than 0'})
 
-        amount = UserBalance.update_balance(request.user, serializer.validated_data['amount'])
-        UserBalanceHistory.objects.create(user=request.user, amount=serializer.validated_data.get('amount'))
+        amount = UserBalance.credit(request.user, serializer.validated_data['amount'], kind=BalanceEntry.Kind.DEPOSIT)
+        UserBalanceHistory.objects.create(user=request.user, amount=to_minor(serializer.validated_data['amount']))
 
         return Response({'amount': amount})
 
@@ -281,7 +538,16 @@ class BalanceHistoryView(IsLoggedIn, ListAPIView):
     """Get list of balance deposits."""
 
     serializer_class = UserBalanceHistorySerializer
+    pagination_class = KeysetPagination
 
     def get_queryset(self):
         """Get user balance history."""
         return UserBalanceHistory.objects.filter(user=self.request.user)
+
+    def get_paginated_response(self, data):
+        """Return page as a plain list like before pagination, with the next page in the Link header."""
+        response = Response(data)
+        next_link = self.paginator.get_next_link()
+        if next_link:
+            response['Link'] = f'<{next_link}>; rel="next"'
+        return response
@@ -105,6 +105,32 @@ if DEBUG is False:
     print(DATABASES['default'])
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+
+def local_cache(location, max_entries):
+    """Cache of this process only, culled when it holds more than max_entries."""
+    return {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': location,
+        'OPTIONS': {'MAX_ENTRIES': max_entries},
+    }
+
+
+CACHES = {
+    # Per process by default, set CACHE_URL to a cache shared by all processes in production.
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+    # Per process caches in front of the database, each in its own location so they do not cull each other.
+    # Order state by activation ID, sized for the orders waiting for an SMS.
+    'activations': local_cache('activations', env.int('ACTIVATION_CACHE_SIZE', default=10000)),
+    # Digests of applied SMS, sized for the SMS a process receives in an hour.
+    'recent_sms': local_cache('recent_sms', env.int('RECENT_SMS_CACHE_SIZE', default=50000)),
+    'balance_shards': local_cache('balance_shards', 10000),
+    'social_tokens': local_cache('social_tokens', 10000),
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -149,10 +175,14 @@ AUTH_USER_MODEL = 'users.User'
 DJANGO_REST_MULTITOKENAUTH_RESET_TOKEN_EXPIRY_TIME = 1
 DJANGO_REST_MULTITOKENAUTH_REQUIRE_USABLE_PASSWORD = False
 
+EMAIL_BACKEND = env('EMAIL_BACKEND', default='django.core.mail.backends.smtp.EmailBackend')
+EMAIL_FILE_PATH = env('EMAIL_FILE_PATH', default=str(BASE_DIR / 'sent_emails'))
 EMAIL_HOST = 'smtp.sendgrid.net'
 EMAIL_USE_TLS = True
 EMAIL_PORT = 587
 EMAIL_HOST_USER = env('EMAIL_HOST', default='')
 EMAIL_HOST_PASSWORD = env('EMAIL_PASS', default='')
+# Seconds before a send to the mail server or SendGrid is given up.
+EMAIL_TIMEOUT = env.float('EMAIL_TIMEOUT', default=10)
 
 CORS_ORIGIN_ALLOW_ALL = True
@@ -0,0 +1,44 @@
+"""Helpers shared by the tests of the apps."""
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Request handler of a stub server answering with JSON."""
+
+    def reply(self, status, body, headers=None):
+        """Send body as JSON with status and headers."""
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Client gave up waiting.
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServerMixin:
+    """Serve `stub_handler` on a local port for the tests of a class, at `url`."""
+
+    stub_handler = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), cls.stub_handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
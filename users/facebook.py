@@ -1,5 +1,19 @@
+import hmac
+import logging
+import time
+from hashlib import sha256
 
-import facebook
+import environ
+import requests
+from django.core.cache import caches
+
+env = environ.Env()
+environ.Env.read_env()
+
+logger = logging.getLogger(__name__)
+
+# Profiles of tokens validated by this process, kept for a short time.
+validated_tokens = caches['social_tokens']
 
 
 class Facebook:
@@ -7,14 +21,61 @@ class Facebook:
     Facebook class to fetch the user info and return it
     """
 
-    @staticmethod
-    def validate(auth_token):
+    graph_url = env('FACEBOOK_GRAPH_URL', default='https://graph.facebook.com')
+    timeout = (env.float('FACEBOOK_CONNECT_TIMEOUT', default=3.05), env.float('FACEBOOK_READ_TIMEOUT', default=5))
+    cache_timeout = env.int('FACEBOOK_CACHE_TIMEOUT', default=5 * 60)
+    app_id = env('FACEBOOK_APP_ID', default='')
+    app_secret = env('FACEBOOK_APP_SECRET', default='')
+    session = requests.Session()
+
+    @classmethod
+    def debug_token(cls, auth_token):
+        """Inspect token with our app's credentials, return its data."""
+        response = cls.session.get(
+            f'{cls.graph_url}/debug_token',
+            params={'input_token': auth_token, 'access_token': f'{cls.app_id}|{cls.app_secret}'},
+            timeout=cls.timeout
+        )
+        response.raise_for_status()
+        return response.json().get('data') or {}
+
+    @classmethod
+    def validate(cls, auth_token):
         """
-        validate method Queries the facebook GraphAPI to fetch the user info
+        validate method Queries the facebook GraphAPI to fetch the user info, None if the token is invalid
+
+        The token must be valid and issued to our app, FACEBOOK_APP_ID, as any app's user
+        token can read the profile of its user.
         """
-        try:
-            graph = facebook.GraphAPI(access_token=auth_token)
-            profile = graph.request('/me?fields=name,email')
+        if not (cls.app_id and cls.app_secret):
+            logger.error('FACEBOOK_APP_ID or FACEBOOK_APP_SECRET is not set, refusing Facebook sign in')
+            return None
+
+        cache_key = f'facebook:{sha256(auth_token.encode()).hexdigest()}'
+        profile = validated_tokens.get(cache_key)
+        if profile is not None:
             return profile
-        except:
-            return "The token is invalid or expired."
\ No newline at end of file
+
+        try:
+            token = cls.debug_token(auth_token)
+            if not token.get('is_valid') or str(token.get('app_id')) != cls.app_id:
+                return None
+            response = cls.session.get(
+                f'{cls.graph_url}/me',
+                params={
+                    'fields': 'first_name,last_name,email',
+                    'access_token': auth_token,
+                    'appsecret_proof': hmac.new(cls.app_secret.encode(), auth_token.encode(), sha256).hexdigest()
+                },
+                timeout=cls.timeout
+            )
+            response.raise_for_status()
+            profile = response.json()
+        except (requests.RequestException, ValueError):
+            return None
+
+        timeout = cls.cache_timeout
+        if token.get('expires_at'):
+            timeout = min(timeout, token['expires_at'] - time.time())
+        validated_tokens.set(cache_key, profile, timeout)
+        return profile
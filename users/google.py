@@ -1,21 +1,90 @@
-from google.auth.transport import requests
-from google.oauth2 import id_token
+import logging
+import re
+import threading
+import time
+from hashlib import sha256
+
+import environ
+import requests
+from django.core.cache import caches
+from google.auth import exceptions, jwt
+
+env = environ.Env()
+environ.Env.read_env()
+
+logger = logging.getLogger(__name__)
+
+# Verified tokens of this process, kept until they expire.
+verified_tokens = caches['social_tokens']
+
+
+class GoogleCerts:
+    """Google's token signing certs, refetched when the max-age of their Cache-Control header has passed."""
+
+    def __init__(self, url, timeout=(3.05, 5), default_max_age=60 * 60):
+        self.url = url
+        self.timeout = timeout
+        self.default_max_age = default_max_age
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.certs = None
+        self.expires_at = 0
+
+    def max_age(self, response):
+        """Seconds the response may be cached for according to its headers."""
+        match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        max_age = int(match[1]) if match else self.default_max_age
+        return max(0, max_age - int(response.headers.get('Age', 0)))
+
+    def get(self, refresh=False):
+        """Get certs by key id, fetching them if expired or refresh is set."""
+        with self.lock:
+            if refresh or self.certs is None or time.monotonic() >= self.expires_at:
+                response = self.session.get(self.url, timeout=self.timeout)
+                response.raise_for_status()
+                self.certs = response.json()
+                self.expires_at = time.monotonic() + self.max_age(response)
+            return self.certs
 
 
 class Google:
     """Google class to fetch the user info and return it"""
 
-    @staticmethod
-    def validate(auth_token):
+    issuers = ['accounts.google.com', 'https://accounts.google.com']
+    certs = GoogleCerts(env('GOOGLE_CERTS_URL', default='https://www.googleapis.com/oauth2/v1/certs'))
+    client_ids = env.list('GOOGLE_CLIENT_IDS', default=[])
+
+    @classmethod
+    def decode(cls, auth_token):
+        """Verify token signature with cached certs, refetching them once for an unknown key id."""
+        certs = cls.certs.get()
+        key_id = jwt.decode_header(auth_token).get('kid')
+        if key_id not in certs:
+            certs = cls.certs.get(refresh=True)
+        return jwt.decode(auth_token, certs=certs, audience=cls.client_ids)
+
+    @classmethod
+    def validate(cls, auth_token):
         """
-        validate method Queries the Google oAUTH2 api to fetch the user info
+        validate method verifies a Google ID token and returns its user info, None if invalid
+
+        Tokens are refused unless GOOGLE_CLIENT_IDS lists the client IDs of our apps, as a
+        token minted for any other app would be accepted otherwise.
         """
-        try:
-            idinfo = id_token.verify_oauth2_token(
-                auth_token, requests.Request())
+        if not cls.client_ids:
+            logger.error('GOOGLE_CLIENT_IDS is not set, refusing Google sign in')
+            return None
+        cache_key = f'google:{sha256(auth_token.encode()).hexdigest()}'
+        idinfo = verified_tokens.get(cache_key)
+        if idinfo is not None:
+            return idinfo
 
-            if 'accounts.google.com' in idinfo['iss']:
-                return idinfo
+        try:
+            idinfo = cls.decode(auth_token)
+        except (ValueError, exceptions.GoogleAuthError, requests.RequestException):
+            return None
+        if idinfo.get('iss') not in cls.issuers:
+            return None
 
-        except:
-            return "The token is either invalid or has expired"
\ No newline at end of file
+        verified_tokens.set(cache_key, idinfo, idinfo['exp'] - time.time())
+        return idinfo
@@ -0,0 +1,128 @@
+"""Provision users in bulk from a CSV or JSON lines file."""
+
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import django
+from django.contrib.auth.hashers import make_password
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.db import IntegrityError, transaction
+from rest_framework.authtoken.models import Token
+
+from orders.models import UserBalance
+from users.models import User
+
+
+def read_rows(path, file_format):
+    """Yield user rows of file one at a time."""
+    with open(path, newline='', encoding='utf-8') as file:
+        if file_format == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def is_valid_row(email, row):
+    """Check if row fits the user model, email being its normalized email."""
+    if any(not isinstance(row.get(field) or '', str) for field in ['email', 'password', 'first_name', 'last_name']):
+        return False
+    lengths = {'email': len(email), 'first_name': len(row.get('first_name') or ''),
+               'last_name': len(row.get('last_name') or '')}
+    if any(length > User._meta.get_field(field).max_length for field, length in lengths.items()):
+        return False
+    try:
+        validate_email(email)
+    except ValidationError:
+        return False
+    return True
+
+
+def chunks(rows, size):
+    """Yield lists of up to size rows."""
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+class Command(BaseCommand):
+    """Create users with their balance and token without going through signup."""
+
+    help = 'Import users from a CSV or JSON lines file with email, password, first_name and last_name fields.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import.')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='File format, guessed from the file extension by default.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of users created per transaction.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes hashing passwords.')
+
+    def new_users(self, chunk, pending):
+        """Users of valid rows of chunk with emails not taken or pending, the last row wins for repeated emails."""
+        users = {}
+        for row in chunk:
+            email = row.get('email') if isinstance(row, dict) else None
+            email = User.objects.normalize_email(email.strip()) if isinstance(email, str) else ''
+            if isinstance(row, dict) and is_valid_row(email, row):
+                users[email] = row
+            else:
+                self.invalid += 1
+        taken = set(User.objects.filter(email__in=users.keys()).values_list('email', flat=True))
+        return {email: row for email, row in users.items() if email not in taken and email not in pending}
+
+    def create(self, rows, hashed):
+        """Create users with their balance and token in one transaction, bypassing post_save signals."""
+        users = [
+            User(email=email, first_name=row.get('first_name') or None, last_name=row.get('last_name') or None,
+                 password=password)
+            for (email, row), password in zip(rows.items(), hashed)
+        ]
+        with transaction.atomic():
+            users = User.objects.bulk_create(users)
+            UserBalance.objects.bulk_create([UserBalance(user_id=user.pk) for user in users])
+            Token.objects.bulk_create([Token(key=Token.generate_key(), user_id=user.pk) for user in users])
+        return len(users)
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        file_format = options['format'] or ('csv' if options['path'].endswith('.csv') else 'jsonl')
+        started = time.monotonic()
+        read = created = self.invalid = 0
+        pending = None
+
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            # Passwords of the next chunk are hashed while the previous one is written.
+            for chunk in chunks(read_rows(options['path'], file_format), options['chunk_size']):
+                read += len(chunk)
+                rows = self.new_users(chunk, pending[0] if pending else {})
+                passwords = [row.get('password') or None for row in rows.values()]
+                hashing = pool.map(make_password, passwords, chunksize=50)
+                if pending:
+                    created += self.write(*pending)
+                pending = rows, hashing
+            if pending:
+                created += self.write(*pending)
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f'Created {created} users, skipped {read - created} of {read} rows ({self.invalid} invalid) '
+            f'in {elapsed:.1f}s ({created / elapsed if elapsed else 0:.0f} users/s)'
+        )
+
+    def write(self, rows, hashing):
+        """Wait for hashed passwords of rows and create their users."""
+        try:
+            created = self.create(rows, list(hashing))
+        except IntegrityError as e:
+            raise CommandError(f'Could not create users, an email was taken meanwhile: {e}')
+        if self.verbosity > 1:
+            self.stdout.write(f'Created {created} users')
+        return created
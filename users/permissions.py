@@ -1,27 +1,154 @@
+from hashlib import sha256
+
 import environ
+from django.core.cache import cache, caches
+from django.db.models import OuterRef
+from django.utils.translation import gettext_lazy as _
 from rest_framework_api_key.permissions import HasAPIKey
 from rest_framework import permissions, authentication, exceptions
-from users.models import UserAPIKey
-from orders.models import SMSHistory
+from rest_framework.authtoken.models import Token
+from orders.models import UserBalance
+from users.models import User, UserAPIKey
+from orders.audit import sms_history
 
 env = environ.Env()
 environ.Env.read_env()
 
 
+class BalanceTokenAuthentication(authentication.TokenAuthentication):
+    """Token authentication that loads user's balance in the same query."""
+
+    def authenticate_credentials(self, key):
+        """Get user and its balance for token."""
+        model = self.get_model()
+        try:
+            token = (
+                model.objects
+                .select_related('user')
+                .annotate(balance_amount=UserBalance.current_amount_of(OuterRef('user_id')))
+                .get(key=key)
+            )
+        except model.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        token.user.balance_amount = token.balance_amount
+
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+
+        return token.user, token
+
+
+TOKEN_CACHE_TIMEOUT = env.int('TOKEN_CACHE_TIMEOUT', default=60)
+token_cache = caches[env('TOKEN_CACHE', default='default')]
+# Fields of the token user kept in cache, never the password hash.
+TOKEN_USER_FIELDS = ['id', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser']
+
+
+def token_cache_key(key):
+    """Cache key for an authenticated token, the token itself is never stored."""
+    return f'token:{sha256(key.encode()).hexdigest()}'
+
+
+def forget_token(user_id):
+    """Drop cached token user, call when the token or the user changes."""
+    user_cache_key = f'token-user:{user_id}'
+    key_cache_key = token_cache.get(user_cache_key)
+    token_cache.delete_many([user_cache_key] + ([key_cache_key] if key_cache_key else []))
+
+
+class CachedTokenAuthentication(BalanceTokenAuthentication):
+    """Token authentication that caches the token's user for TOKEN_CACHE_TIMEOUT seconds.
+
+    Only the user's TOKEN_USER_FIELDS are cached, and a cache hit gives a user
+    with the other fields deferred, which is fine for reading but may be stale:
+    views changing the user have to load it from the database. The balance is
+    loaded when used so it is never stale. Cached users are dropped by
+    `forget_token`, which runs when a token is deleted or its user saved;
+    changes made with queryset `update()` send no signal and are seen only once
+    the cached copy expires. Sign out, password changes and deactivation apply
+    immediately in every process only if TOKEN_CACHE names a cache shared by
+    all of them; with a per process cache they apply in this process and
+    expire on their own in others.
+    """
+
+    def authenticate_credentials(self, key):
+        """Get user for token from cache, or from the database and cache it."""
+        key_cache_key = token_cache_key(key)
+        values = token_cache.get(key_cache_key)
+        if values is not None:
+            user = User.from_db(None, TOKEN_USER_FIELDS, values)
+            user.balance_amount = None
+            return user, Token(key=key, user=user)
+
+        user, token = super().authenticate_credentials(key)
+        values = [getattr(user, field) for field in TOKEN_USER_FIELDS]
+        token_cache.set_many({key_cache_key: values, f'token-user:{user.pk}': key_cache_key}, TOKEN_CACHE_TIMEOUT)
+        return user, token
+
+
 class IsLoggedIn:
     """Check if user is logged in."""
-    authentication_classes = [authentication.TokenAuthentication, ]
+    authentication_classes = [CachedTokenAuthentication, ]
     permission_classes = [permissions.IsAuthenticated, ]
 
 
+API_KEY_CACHE_TIMEOUT = env.int('API_KEY_CACHE_TIMEOUT', default=60)
+
+
+def api_key_cache_key(key):
+    """Cache key for a verified API key, the key itself is never stored."""
+    return f'api-key:{sha256(key.encode()).hexdigest()}'
+
+
+def forget_api_key(user_id):
+    """Drop verified key of user from cache, call when the key is replaced or revoked."""
+    user_cache_key = f'api-key-user:{user_id}'
+    key_cache_key = cache.get(user_cache_key)
+    cache.delete_many([user_cache_key] + ([key_cache_key] if key_cache_key else []))
+
+
 class UserHasAPIKey(HasAPIKey):
-    """Permission to check if the key is valid."""
+    """Permission to check if the key is valid.
+
+    The key is verified once per request and the owner's id is attached to the
+    request as `api_key_user_id`. Verified keys are cached by digest in the
+    default cache for API_KEY_CACHE_TIMEOUT seconds, so repeat calls skip the
+    slow password hasher. `forget_api_key` drops a replaced key from the
+    default cache, which reaches every process only if CACHE_URL names a
+    shared cache. A revoked key is accepted for up to API_KEY_CACHE_TIMEOUT
+    seconds where it is still cached: in other processes with the per process
+    default cache, or everywhere if it was revoked without `forget_api_key`.
+    """
 
     model = UserAPIKey
 
     def __init__(self, *args, **kwargs):
         self.key_parser.keyword = 'Bearer'
 
+    def get_user_id(self, key):
+        """Get id of the user owning a valid key, None if key is not valid."""
+        key_cache_key = api_key_cache_key(key)
+        user_id = cache.get(key_cache_key)
+        if user_id is not None:
+            return user_id
+
+        try:
+            api_key = self.model.objects.get_from_key(key)
+        except self.model.DoesNotExist:
+            return None
+        if api_key.has_expired:
+            return None
+
+        cache.set_many({key_cache_key: api_key.user_id, f'api-key-user:{api_key.user_id}': key_cache_key},
+                       API_KEY_CACHE_TIMEOUT)
+        return api_key.user_id
+
+    def has_permission(self, request, view):
+        """Check key and attach id of its user to request."""
+        key = self.get_key(request)
+        request.api_key_user_id = self.get_user_id(key) if key else None
+        return request.api_key_user_id is not None
+
 
 class IsUserAPI:
     """Check if user has valid API key."""
@@ -32,10 +159,12 @@ class IsUserAPI:
 class SMSSenderKeyAuthentication(authentication.BaseAuthentication):
     """Authenticate if request is from our trusted API sender."""
 
+    record_history = True
+
     @staticmethod
     def _add_to_history(request):
-        """Record request params."""
-        SMSHistory.objects.create(request_data=request.data)
+        """Record request params, written in the background with other records."""
+        sms_history.add(request.data)
 
     def authenticate(self, request):
         """Check if key sent in header is valid."""
@@ -43,4 +172,11 @@ class SMSSenderKeyAuthentication(authentication.BaseAuthentication):
         if key != env('SMS_KEY', default=''):
             raise exceptions.AuthenticationFailed
 
-        self._add_to_history(request)
+        if self.record_history:
+            self._add_to_history(request)
+
+
+class SMSSenderBatchKeyAuthentication(SMSSenderKeyAuthentication):
+    """Authenticate batches from our trusted API sender, history is recorded per SMS by the view."""
+
+    record_history = False
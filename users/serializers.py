@@ -8,6 +8,8 @@ Includes serializers for:
 
 """
 
+from abc import ABCMeta, abstractmethod
+
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from django.contrib.auth import get_user_model
@@ -15,7 +17,8 @@ from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
-from users.models import User
+from users.facebook import Facebook
+from users.google import Google
 
 class SignUpSerializer(serializers.ModelSerializer):
     """Create a User."""
@@ -34,21 +37,12 @@ class SignUpSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError({"password": "Password fields didn't match."})
 
         return attrs
-    def validate_email(self, value):
-        if User.objects.filter(email=value).exists():
-            raise serializers.ValidationError("A user with this email already exists!")
-        return value       
 
     def create(self, validated_data):
         """Create user with all validated data."""
         validated_data.pop('confirm_password')
-        user = get_user_model().objects.create_user(**validated_data)
-        
-        print("done",type(user))
-        print(str(user))
-        return str(user)
-        
-        
+        return get_user_model().objects.create_user(**validated_data)
+
     class Meta:
         model = get_user_model()
         fields = ['email', 'password', 'confirm_password']
@@ -78,6 +72,48 @@ class SignInSerializer(serializers.Serializer):
         return attrs
 
 
+class AbstractSerializerMetaclass(serializers.SerializerMetaclass, ABCMeta):
+    """Metaclass of serializers declaring abstract methods."""
+
+
+class SocialSignInSerializer(serializers.Serializer, metaclass=AbstractSerializerMetaclass):
+    """Sign in with a token issued by a social provider."""
+
+    auth_token = serializers.CharField()
+
+    @abstractmethod
+    def get_profile(self, auth_token):
+        """Return (email, first_name, last_name) of verified token owner, None if token is invalid."""
+        pass
+
+    def validate_auth_token(self, value):
+        """Verify token with the provider."""
+        profile = self.get_profile(value)
+        if not profile or not profile[0]:
+            raise serializers.ValidationError('The token is invalid or expired.')
+        return profile
+
+
+class GoogleSignInSerializer(SocialSignInSerializer):
+    """Sign in with a Google ID token."""
+
+    def get_profile(self, auth_token):
+        idinfo = Google.validate(auth_token)
+        if not idinfo or not idinfo.get('email_verified'):
+            return None
+        return idinfo.get('email'), idinfo.get('given_name'), idinfo.get('family_name')
+
+
+class FacebookSignInSerializer(SocialSignInSerializer):
+    """Sign in with a Facebook access token."""
+
+    def get_profile(self, auth_token):
+        profile = Facebook.validate(auth_token)
+        if not profile:
+            return None
+        return profile.get('email'), profile.get('first_name'), profile.get('last_name')
+
+
 class ProfileDisplaySerializer(serializers.ModelSerializer):
     """Display User information."""
 
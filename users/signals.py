@@ -0,0 +1,19 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from users.models import User
+from users.permissions import forget_token
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    """Stop authenticating a deleted token, e.g. on sign out."""
+    forget_token(instance.user_id)
+
+
+@receiver(post_save, sender=User)
+def forget_saved_user_token(sender, instance, created, **kwargs):
+    """Drop cached copy of a changed user, e.g. on password change or deactivation."""
+    if not created:
+        forget_token(instance.pk)
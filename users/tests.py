@@ -1,3 +1,275 @@
+import hmac
+import io
+import json
+import tempfile
+import time
+from hashlib import sha256
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from django.core.cache import cache
+from django.core.management import call_command
 from django.test import TestCase
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from google.auth import crypt, jwt
+from rest_framework.test import APIRequestFactory
+
+from simswitch.testing import StubHandler, StubServerMixin
+from users.models import User, UserAPIKey
+from users.facebook import Facebook
+from users.google import Google, GoogleCerts
+from users.permissions import CachedTokenAuthentication, UserHasAPIKey, token_cache_key
+from users.throttling import MemoryBucketStore, SignInEmailThrottle, UserOrderThrottle, stats
+
+
+class UserHasAPIKeyTest(TestCase):
+    """API keys are verified once and then served from cache until rotated."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user@example.com', 'password')
+        _, self.key = UserAPIKey.objects.create_key(user=self.user, prefix=self.user.email, name='Key')
+
+    def check_key(self, key):
+        request = APIRequestFactory().post('/', HTTP_AUTHORIZATION=f'Bearer {key}')
+        return UserHasAPIKey().has_permission(request, None), request.api_key_user_id
+
+    def test_verified_key_is_cached(self):
+        self.assertEqual(self.check_key(self.key), (True, self.user.pk))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.check_key(self.key), (True, self.user.pk))
+
+    def test_invalid_key(self):
+        self.assertEqual(self.check_key(self.key + 'x'), (False, None))
+
+    def test_rotation_forgets_key(self):
+        self.check_key(self.key)
+        token = Token.objects.create(user=self.user)
+        response = self.client.get('/user/key', HTTP_AUTHORIZATION=f'Token {token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.check_key(self.key), (False, None))
+        self.assertEqual(self.check_key(response.data['key']), (True, self.user.pk))
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    """Token users are served from cache until the token or user changes."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user@example.com', 'password')
+        self.token = Token.objects.create(user=self.user)
+
+    def authenticate(self):
+        request = APIRequestFactory().get('/', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        return CachedTokenAuthentication().authenticate(request)
+
+    def test_user_is_cached(self):
+        self.authenticate()
+        with self.assertNumQueries(0):
+            user, token = self.authenticate()
+        self.assertEqual((user.pk, token.key), (self.user.pk, self.token.key))
+
+    def test_sign_out_forgets_token(self):
+        self.authenticate()
+        response = self.client.get('/user/signout', HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 200)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_deactivation_forgets_user(self):
+        self.authenticate()
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_cached_user_is_not_saved_back(self):
+        self.authenticate()
+        self.assertNotIn(self.user.password, str(cache.get(token_cache_key(self.token.key))))
+        User.objects.filter(pk=self.user.pk).update(last_name='Changed', password='changed')
+        response = self.client.patch('/user/update', {'first_name': 'New'}, content_type='application/json',
+                                     HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.first_name, self.user.last_name, self.user.password),
+                         ('New', 'Changed', 'changed'))
+
+
+class ThrottleTest(TestCase):
+    """Throttled requests are rejected before credentials are checked."""
+
+    def setUp(self):
+        self.store = mock.patch('users.throttling.store', MemoryBucketStore())
+        self.store.start()
+        self.addCleanup(self.store.stop)
+
+    @mock.patch.object(SignInEmailThrottle, 'rate', '2/min')
+    def test_sign_in_per_email(self):
+        statuses = [
+            self.client.post('/user/signin', {'email': 'user@example.com', 'password': 'wrong'}).status_code
+            for _ in range(3)
+        ]
+        self.assertEqual(statuses, [400, 400, 429])
+        response = self.client.post('/user/signin', {'email': 'other@example.com', 'password': 'wrong'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stats_list_every_scope(self):
+        self.assertEqual(set(stats.as_dict()), {'signin_ip', 'signin_email', 'app_place', 'user_place',
+                                                'user_place_bulk'})
+
+    @mock.patch.object(UserOrderThrottle, 'rate', '1/min')
+    def test_user_place_before_key_check(self):
+        self.client.post('/order/user_place', HTTP_AUTHORIZATION='Bearer prefix.secret')
+        with mock.patch('users.permissions.UserHasAPIKey.get_user_id') as get_user_id:
+            response = self.client.post('/order/user_place', HTTP_AUTHORIZATION='Bearer prefix.other')
+        self.assertEqual(response.status_code, 429)
+        get_user_id.assert_not_called()
+
+
+class SignupTest(TestCase):
+    """Signup creates user, balance and token in one transaction."""
+
+    data = {'email': 'user@example.com', 'password': 'Secret-pass-1', 'confirm_password': 'Secret-pass-1'}
+
+    def test_signup(self):
+        # Savepoint, user, balance, token, release.
+        with self.assertNumQueries(5):
+            response = self.client.post('/user/signup', self.data)
+        self.assertEqual(response.status_code, 200)
+        user = User.objects.get(email='user@example.com')
+        self.assertEqual(response.data['token'], user.auth_token.key)
+        self.assertEqual(user.balance.amount, 0)
+
+    def test_email_taken(self):
+        User.objects.create_user('user@example.com', 'password')
+        response = self.client.post('/user/signup', self.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'email': ['A user with this email already exists!']})
+
+
+class ImportUsersTest(TestCase):
+    """Bulk import creates valid users and skips the rows that can not be stored."""
+
+    def test_invalid_rows_are_skipped(self):
+        User.objects.create_user('taken@example.com', 'password')
+        rows = [
+            {'email': 'new@example.com', 'password': 'password', 'first_name': 'New'},
+            {'email': 'taken@example.com', 'password': 'password'},
+            {'email': 'not an email', 'password': 'password'},
+            {'email': f'{"a" * 170}@example.com', 'password': 'password'},
+            {'email': 'long@example.com', 'password': 'password', 'last_name': 'x' * 31},
+            {'email': ['list@example.com'], 'password': 'password'},
+            ['not', 'a', 'row'],
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as file:
+            file.write('\n'.join(json.dumps(row) for row in rows))
+            file.flush()
+            out = io.StringIO()
+            call_command('import_users', file.name, workers=1, stdout=out)
+        self.assertIn('Created 1 users, skipped 6 of 7 rows (5 invalid)', out.getvalue())
+        user = User.objects.get(email='new@example.com')
+        self.assertTrue(user.check_password('password'))
+        self.assertTrue(Token.objects.filter(user=user).exists())
+
+
+class StubProviderHandler(StubHandler):
+    """Serve Google certs and the Facebook Graph token data and profile of the stub tokens."""
+
+    certs = {}
+    profiles = {}
+    apps = {}
+    requests = []
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        self.requests.append(url.path)
+        if url.path == '/certs':
+            status, headers, body = 200, {'Cache-Control': 'public, max-age=3600'}, self.certs
+        elif url.path == '/debug_token' and query.get('access_token') == 'app|secret':
+            app_id = self.apps.get(query.get('input_token'))
+            status, headers, body = 200, {}, {'data': {'app_id': app_id, 'is_valid': app_id is not None}}
+        elif url.path == '/me' and query.get('access_token') in self.profiles and query.get('appsecret_proof') == \
+                hmac.new(b'secret', query['access_token'].encode(), sha256).hexdigest():
+            status, headers, body = 200, {}, self.profiles[query['access_token']]
+        else:
+            status, headers, body = 400, {}, {'error': {'message': 'Invalid OAuth access token.'}}
+        self.reply(status, body, headers)
+
+
+class SocialSignInTest(StubServerMixin, TestCase):
+    """Social sign in verifies tokens offline against a stub key set and Graph server."""
+
+    stub_handler = StubProviderHandler
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cls.signer = crypt.RSASigner.from_string(
+            key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()),
+            key_id='stub'
+        )
+        StubProviderHandler.certs = {'stub': key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        ).decode()}
+        StubProviderHandler.profiles = {'facebook-token': {'email': 'fb@example.com', 'first_name': 'Fb'},
+                                        'other-app-token': {'email': 'other@example.com'}}
+        StubProviderHandler.apps = {'facebook-token': 'app', 'other-app-token': 'other'}
+
+    def setUp(self):
+        cache.clear()
+        StubProviderHandler.requests.clear()
+        for patcher in [mock.patch.object(Google, 'certs', GoogleCerts(f'{self.url}/certs')),
+                        mock.patch.object(Google, 'client_ids', ['client']),
+                        mock.patch.object(Facebook, 'graph_url', self.url),
+                        mock.patch.object(Facebook, 'app_id', 'app'),
+                        mock.patch.object(Facebook, 'app_secret', 'secret'),
+                        mock.patch('users.throttling.store', MemoryBucketStore())]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def google_token(self, **claims):
+        now = int(time.time())
+        payload = {'iss': 'https://accounts.google.com', 'aud': 'client', 'iat': now, 'exp': now + 3600,
+                   'email': 'g@example.com', 'email_verified': True, 'given_name': 'G'}
+        return jwt.encode(self.signer, {**payload, **claims}).decode()
+
+    def test_google_sign_in(self):
+        token = self.google_token()
+        for _ in range(2):
+            response = self.client.post('/user/signin/google', {'auth_token': token})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['token'], User.objects.get(email='g@example.com').auth_token.key)
+        self.client.post('/user/signin/google', {'auth_token': self.google_token(iat=int(time.time()) - 1)})
+        self.assertEqual(StubProviderHandler.requests, ['/certs'])
+
+    def test_google_invalid_token(self):
+        for token in [self.google_token(aud='other'), self.google_token(email_verified=False), 'garbage']:
+            response = self.client.post('/user/signin/google', {'auth_token': token})
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.exists())
+
+    def test_google_refused_without_client_ids(self):
+        with mock.patch.object(Google, 'client_ids', []), self.assertLogs('users.google', 'ERROR'):
+            response = self.client.post('/user/signin/google', {'auth_token': self.google_token()})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.exists())
+
+    def test_facebook_sign_in(self):
+        for _ in range(2):
+            response = self.client.post('/user/signin/facebook', {'auth_token': 'facebook-token'})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(User.objects.get(email='fb@example.com').first_name, 'Fb')
+        self.assertEqual(StubProviderHandler.requests, ['/debug_token', '/me'])
 
-# Create your tests here.
+    def test_facebook_invalid_token(self):
+        for token in ['invalid', 'other-app-token']:
+            response = self.client.post('/user/signin/facebook', {'auth_token': token})
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.exists())
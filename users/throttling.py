@@ -0,0 +1,210 @@
+"""Token bucket throttles for sign in and order placement.
+
+Each throttle scope has a bucket per identity (IP, email, API key or token)
+holding up to `capacity` tokens, refilled at `capacity` per `period`. A request
+takes a token or is rejected with 429, before any password hashing, key
+verification or provider call. Buckets live in the store named by the
+THROTTLE_STORE setting, an in-memory store per process by default.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from hashlib import sha256
+
+import environ
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from rest_framework.throttling import BaseThrottle
+
+env = environ.Env()
+environ.Env.read_env()
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 60 * 60 * 24}
+
+
+def parse_rate(rate):
+    """Parse rate like '5/min' into (capacity, period in seconds)."""
+    count, period = rate.split('/')
+    return int(count), PERIODS[period[0]]
+
+
+class MemoryBucketStore:
+    """Buckets in memory of this process, the least recently used are dropped past max_entries."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, period, now):
+        """Take a token from bucket, return seconds to wait for one or 0 if taken."""
+        with self.lock:
+            tokens, updated = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * capacity / period)
+            wait = 0 if tokens >= 1 else (1 - tokens) * period / capacity
+            self.buckets[key] = (tokens - 1 if not wait else tokens, now)
+            if len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class CacheBucketStore:
+    """Buckets in a Django cache shared by all processes, named by THROTTLE_CACHE.
+
+    Reading and writing a bucket is not atomic, so concurrent requests of one
+    identity may occasionally both get the last token.
+    """
+
+    def __init__(self):
+        self.cache = caches[env('THROTTLE_CACHE', default='default')]
+
+    def take(self, key, capacity, period, now):
+        """Take a token from bucket, return seconds to wait for one or 0 if taken."""
+        tokens, updated = self.cache.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * capacity / period)
+        wait = 0 if tokens >= 1 else (1 - tokens) * period / capacity
+        self.cache.set(key, (tokens - 1 if not wait else tokens, now), period)
+        return wait
+
+
+class ThrottleStats:
+    """Count allowed and rejected requests per scope in this process."""
+
+    def __init__(self):
+        self.allowed = Counter()
+        self.rejected = Counter()
+
+    def record(self, scope, allowed):
+        """Count request of scope."""
+        (self.allowed if allowed else self.rejected)[scope] += 1
+
+    def as_dict(self):
+        """Counters and rates per scope."""
+        return {
+            throttle.scope: {
+                'rate': throttle.rate,
+                'allowed': self.allowed[throttle.scope],
+                'rejected': self.rejected[throttle.scope],
+            }
+            for throttle in throttle_classes(TokenBucketThrottle)
+        }
+
+
+def throttle_classes(base):
+    """Subclasses of base at any depth that have a scope."""
+    for throttle in base.__subclasses__():
+        if throttle.scope:
+            yield throttle
+        yield from throttle_classes(throttle)
+
+
+store = import_string(env('THROTTLE_STORE', default='users.throttling.MemoryBucketStore'))()
+stats = ThrottleStats()
+
+
+class TokenBucketThrottle(BaseThrottle, ABC):
+    """Throttle requests of an identity with a token bucket of the scope."""
+
+    scope = None
+    rate = None
+
+    def __init__(self):
+        self.capacity, self.period = parse_rate(self.rate)
+        self.wait_seconds = None
+
+    @abstractmethod
+    def get_identity(self, request):
+        """Identity sharing a bucket, None to not throttle the request."""
+        pass
+
+    def allow_request(self, request, view):
+        """Take a token from the bucket of the request's identity."""
+        identity = self.get_identity(request)
+        if identity is None:
+            return True
+
+        key = f'throttle:{self.scope}:{sha256(str(identity).encode()).hexdigest()}'
+        self.wait_seconds = store.take(key, self.capacity, self.period, time.time())
+        stats.record(self.scope, not self.wait_seconds)
+        return not self.wait_seconds
+
+    def wait(self):
+        """Seconds until the next token."""
+        return self.wait_seconds
+
+
+def authorization_credential(request, keyword):
+    """Credential of the Authorization header if it uses keyword."""
+    parts = request.META.get('HTTP_AUTHORIZATION', '').split()
+    return parts[1] if len(parts) == 2 and parts[0] == keyword else None
+
+
+class SignInIPThrottle(TokenBucketThrottle):
+    """Throttle sign in attempts per client IP."""
+
+    scope = 'signin_ip'
+    rate = env('THROTTLE_SIGNIN_IP_RATE', default='30/min')
+
+    def get_identity(self, request):
+        return self.get_ident(request)
+
+
+class SignInEmailThrottle(TokenBucketThrottle):
+    """Throttle sign in attempts per email."""
+
+    scope = 'signin_email'
+    rate = env('THROTTLE_SIGNIN_EMAIL_RATE', default='10/min')
+
+    def get_identity(self, request):
+        email = request.data.get('email') if hasattr(request.data, 'get') else None
+        return email.strip().lower() if isinstance(email, str) else None
+
+
+class AppOrderThrottle(TokenBucketThrottle):
+    """Throttle orders from the frontend app per token."""
+
+    scope = 'app_place'
+    rate = env('THROTTLE_APP_PLACE_RATE', default='60/min')
+
+    def get_identity(self, request):
+        return authorization_credential(request, 'Token')
+
+
+class UserOrderThrottle(TokenBucketThrottle):
+    """Throttle orders from the API per key, identified by its prefix before the key is verified."""
+
+    scope = 'user_place'
+    rate = env('THROTTLE_USER_PLACE_RATE', default='120/min')
+
+    def get_identity(self, request):
+        key = authorization_credential(request, 'Bearer')
+        return key.partition('.')[0] if key else None
+
+
+class BulkOrderThrottle(UserOrderThrottle):
+    """Throttle bulk orders from the API per key."""
+
+    scope = 'user_place_bulk'
+    rate = env('THROTTLE_USER_PLACE_BULK_RATE', default='10/min')
+
+
+class ThrottleBeforePermissions:
+    """Check throttles before permissions, for views whose permission check is expensive."""
+
+    def check_permissions(self, request):
+        """Check throttles, then permissions."""
+        super().check_throttles(request)
+        super().check_permissions(request)
+
+    def check_throttles(self, request):
+        """Throttles were checked with permissions."""
+        pass
+
+
+def throttle_wait(throttle_classes, request, view):
+    """Check throttles outside DRF views, return seconds to wait if throttled."""
+    waits = [throttle.wait() for throttle in (cls() for cls in throttle_classes)
+             if not throttle.allow_request(request, view)]
+    return max(waits) if waits else None
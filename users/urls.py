@@ -4,11 +4,14 @@ from django.urls import path, include
 from users.views import (
     SignupView,
     SignInView,
+    GoogleSignInView,
+    FacebookSignInView,
     ProfileUpdateView,
     SignOutView,
     GetAPIKeyView,
  
        ChangePasswordView,
+    ThrottleStatsView,
 )
 
 app_name = 'users'
@@ -16,9 +19,12 @@ app_name = 'users'
 urlpatterns = [
     path('signup', SignupView.as_view(), name='sign-up'),
     path('signin', SignInView.as_view(), name='sign-in'),
+    path('signin/google', GoogleSignInView.as_view(), name='sign-in-google'),
+    path('signin/facebook', FacebookSignInView.as_view(), name='sign-in-facebook'),
     path('signout', SignOutView.as_view(), name='sign-out'),
     path('update', ProfileUpdateView.as_view(), name='profile'),
     path('key', GetAPIKeyView.as_view(), name='profile'),
     path('change_password', ChangePasswordView.as_view(), name='change-password'),
+    path('throttles', ThrottleStatsView.as_view(), name='throttle-stats'),
     path('reset_password', include('django_rest_passwordreset.urls', namespace='password_reset')),
 ]
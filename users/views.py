@@ -2,7 +2,7 @@
 
 Includes views for:
     1. SignUp
-    2. SignIn
+    2. SignIn, also with Google and Facebook
     3. Profile View and Update
     4. Sign Out
 """
@@ -12,45 +12,103 @@ from django.contrib.auth.hashers import (
     make_password,
 )
 from django.contrib.auth import authenticate
+from django.db import IntegrityError, transaction
 
 from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
 from rest_framework.status import HTTP_200_OK, HTTP_406_NOT_ACCEPTABLE, HTTP_400_BAD_REQUEST
 from rest_framework.generics import CreateAPIView, RetrieveUpdateAPIView
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.settings import api_settings
-from users.serializers import SignUpSerializer, SignInSerializer, ProfileDisplaySerializer, ChangePasswordSerializer
-from users.permissions import IsLoggedIn
-from users.models import UserAPIKey , User
+from rest_framework.permissions import IsAdminUser
+from users.serializers import (
+    SignUpSerializer,
+    SignInSerializer,
+    GoogleSignInSerializer,
+    FacebookSignInSerializer,
+    ProfileDisplaySerializer,
+    ChangePasswordSerializer,
+)
+from users.permissions import IsLoggedIn, forget_api_key
+from orders.models import UserBalance
+from users.models import User, UserAPIKey
+from users.throttling import SignInEmailThrottle, SignInIPThrottle, stats, store
 
 
 class SignupView(CreateAPIView):
     """Create a User."""
-    print("non")
     serializer_class = SignUpSerializer
 
     def post(self, request, *args, **kwargs):
+        """Create user, its balance and token in one transaction, a taken email fails on the unique constraint."""
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        email = serializer.validated_data['email']
-        serializer.save()
-        user_inital = User.objects.filter(email=email).first()
-        token, created = Token.objects.get_or_create(user= user_inital)
-        return Response({'token': token.key, 'email' : email})
-        
+        try:
+            with transaction.atomic():
+                user = serializer.save()
+                token = Token.objects.create(user=user)
+        except IntegrityError:
+            raise ValidationError({'email': ['A user with this email already exists!']})
+        return Response({'token': token.key, 'email': serializer.validated_data['email']})
+
 
 class SignInView(ObtainAuthToken):
     """Sign In User."""
     serializer_class = SignInSerializer
     renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES
+    throttle_classes = [SignInIPThrottle, SignInEmailThrottle]
 
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         token, created = Token.objects.get_or_create(user=user)
-        return Response({'token': token.key, 'balance': user.balance.amount})
+        return Response({'token': token.key, 'balance': UserBalance.amount_of(user)})
+
+
+class SocialSignInView(APIView):
+    """Sign in with a social provider token, creating the user on first sign in."""
+
+    serializer_class = None
+    throttle_classes = [SignInIPThrottle, ]
+
+    @staticmethod
+    def get_user(email, first_name, last_name):
+        """Get user with email or create one without a usable password."""
+        user = User.objects.filter(email=email).first()
+        if user is not None:
+            return user
+        try:
+            with transaction.atomic():
+                return User.objects.create_user(email, first_name=(first_name or '')[:30] or None,
+                                                last_name=(last_name or '')[:30] or None)
+        except IntegrityError:
+            # Signed up concurrently.
+            return User.objects.get(email=email)
+
+    def post(self, request):
+        """Verify token and return auth token of its user."""
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        user = self.get_user(*serializer.validated_data['auth_token'])
+        if not user.is_active:
+            raise AuthenticationFailed('User inactive or deleted.')
+        token, created = Token.objects.get_or_create(user=user)
+        return Response({'token': token.key, 'balance': UserBalance.amount_of(user)})
+
+
+class GoogleSignInView(SocialSignInView):
+    """Sign in with Google."""
+
+    serializer_class = GoogleSignInSerializer
+
+
+class FacebookSignInView(SocialSignInView):
+    """Sign in with Facebook."""
+
+    serializer_class = FacebookSignInSerializer
 
 
 class ProfileUpdateView(IsLoggedIn, RetrieveUpdateAPIView):
@@ -59,8 +117,8 @@ class ProfileUpdateView(IsLoggedIn, RetrieveUpdateAPIView):
     serializer_class = ProfileDisplaySerializer
 
     def get_object(self):
-        """Return object instance."""
-        return self.request.user
+        """Return object instance, loaded afresh as the authenticated user may be a cached copy."""
+        return User.objects.get(pk=self.request.user.pk)
 
 
 class GetAPIKeyView(IsLoggedIn, APIView):
@@ -70,6 +128,7 @@ class GetAPIKeyView(IsLoggedIn, APIView):
         """Get API key for user."""
         user = request.user
         UserAPIKey.objects.filter(user=user).delete()
+        forget_api_key(user.pk)
         _, key = UserAPIKey.objects.create_key(user=user, prefix=user.email, name=f'Key for {user.email}')
         return Response(status=HTTP_200_OK, data={'key': key})
 
@@ -89,9 +148,10 @@ class ChangePasswordView(IsLoggedIn, APIView):
         is_valid, passwords = self.get_passwords(request.data)
         if is_valid is False:
             return Response(status=HTTP_400_BAD_REQUEST, data=passwords)
-        if check_password(passwords['old_password'], request.user.password):
-            request.user.password = make_password(passwords['password'])
-            request.user.save()
+        user = User.objects.get(pk=request.user.pk)
+        if check_password(passwords['old_password'], user.password):
+            user.password = make_password(passwords['password'])
+            user.save(update_fields=['password'])
             return Response(status=HTTP_200_OK, data={'message': 'Password Updated!'})
         else:
             return Response(status=HTTP_406_NOT_ACCEPTABLE, data={'message': 'Old Password does not match.'})
@@ -104,3 +164,13 @@ class SignOutView(IsLoggedIn, APIView):
         """Sign Out User on Get Request."""
         request.user.auth_token.delete()
         return Response(status=HTTP_200_OK)
+
+
+class ThrottleStatsView(IsLoggedIn, APIView):
+    """Show throttle counters of this process to staff."""
+
+    permission_classes = [IsAdminUser, ]
+
+    def get(self, request):
+        """Get allowed and rejected request counts per throttle scope."""
+        return Response(status=HTTP_200_OK, data={'store': type(store).__name__, 'scopes': stats.as_dict()})